@@ -5,8 +5,8 @@
 import cv2
 import json
 import numpy as np
-from collections import defaultdict, deque
-from yoloe_rt import YoloeRealtime
+from collections import defaultdict
+from yoloe_rt import YoloeRealtime, GID_PALETTE, color_for_gid, draw_label
 from fetch_frame import get_frame
 import threading
 
@@ -17,6 +17,9 @@ TRAIL_MAX_AGE_FRAMES  = 120   # segments older than this are dropped (~4s at 30
 TRAIL_CAP_PER_OBJ     = 200   # hard cap per-object (safety)
 MAP_PAD               = 0.5
 PANEL_MATCH_H         = True
+PANEL_RENDER_SCALE    = 0.5   # grid + trails rasterized at this scale, upscaled once
+PANEL_SCALE_MIN_TRAILS = 8    # below this many trails full-res rendering is cheap enough
+PANEL_REUSE_FRAMES    = 3     # unchanged scene: re-render the panel at most every N frames (fade still animates)
 
 FONT = cv2.FONT_HERSHEY_SIMPLEX
 WIN  = "YOLOE • Live | Top-down (fading)"
@@ -35,20 +38,52 @@ def get_global_rt():
     return _global_rt
 
 def color_for_id(gid: int):
-    return (
-        60 + (37 * (gid + 1)) % 195,
-        60 + (91 * (gid + 1)) % 195,
-        60 + (13 * (gid + 1)) % 195,
-    )
+    return color_for_gid(gid)
 
-def render_topdown_panel(panel_h, panel_w, objects, trails, bounds, cur_frame):
+class TrailBuf:
     """
-    Draw top-down X-Y map with fading trails.
-    trails: gid -> deque[(Xw, Yw, frame_idx)]
+    Fixed-size ring of (Xw, Yw, frame) float32 rows for one gid; the oldest row is overwritten when full.
+    Frames are stored relative to `base` so they stay exact in float32 (< 2**24) on long-running sessions.
+    """
+    __slots__ = ("buf", "head", "count", "base")
+
+    _REBASE_AT = 1 << 23
+
+    def __init__(self, cap: int = TRAIL_CAP_PER_OBJ):
+        self.buf = np.empty((cap, 3), np.float32)
+        self.head = 0   # next write slot
+        self.count = 0
+        self.base = 0   # absolute frame index of relative frame 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, x: float, y: float, frame_idx: int):
+        if self.count == 0:
+            self.base = frame_idx
+        elif frame_idx - self.base >= self._REBASE_AT:
+            shift = frame_idx - self.base   # recent rows go slightly negative, still exact
+            self.buf[:, 2] -= shift
+            self.base += shift
+        self.buf[self.head] = (x, y, frame_idx - self.base)
+        self.head = (self.head + 1) % len(self.buf)
+        self.count = min(self.count + 1, len(self.buf))
+
+    def newest_frame(self) -> int:
+        return self.base + int(self.buf[self.head - 1, 2])
+
+    def view(self) -> np.ndarray:
+        """Valid rows in chronological order (newest last); frame column is relative to `base`."""
+        if self.count < len(self.buf):
+            return self.buf[:self.count]
+        return np.concatenate((self.buf[self.head:], self.buf[:self.head]))
+
+def topdown_affine(panel_h, panel_w, bounds):
+    """
+    Build the 2x3 world (X, Y) -> panel pixel affine for the top-down map.
+    Y is flipped so +Y points up on screen. Recompute only when bounds change.
     """
     H, W = panel_h, panel_w
-    img = np.full((H, W, 3), 18, np.uint8)
-
     xmin, xmax = bounds["xmin"], bounds["xmax"]
     ymin, ymax = bounds["ymin"], bounds["ymax"]
 
@@ -58,10 +93,47 @@ def render_topdown_panel(panel_h, panel_w, objects, trails, bounds, cur_frame):
     if abs(ymax - ymin) < 1e-3:
         cy = 0.5 * (ymin + ymax); ymin, ymax = cy - 0.5, cy + 0.5
 
-    def world_to_px(x, y):
-        u = int((x - xmin) / max(1e-6, (xmax - xmin)) * (W - 1))
-        v = int((1.0 - (y - ymin) / max(1e-6, (ymax - ymin))) * (H - 1))
-        return u, v
+    sx = (W - 1) / max(1e-6, (xmax - xmin))
+    sy = -(H - 1) / max(1e-6, (ymax - ymin))
+    tx = -xmin * sx
+    ty = (H - 1) - ymin * sy
+    return np.array([[sx, 0.0, tx], [0.0, sy, ty]], dtype=np.float32)
+
+def world_to_px(M, pts):
+    """Apply the top-down affine M to an (N, 2) array of world points -> (N, 2) int32 pixels."""
+    return (pts @ M[:, :2].T + M[:, 2]).astype(np.int32)
+
+def render_topdown_panel(panel_h, panel_w, objects, trails, M, cur_frame, render_scale=1.0):
+    """
+    Draw top-down X-Y map with fading trails.
+    trails: gid -> TrailBuf; gids idle for longer than TRAIL_MAX_AGE_FRAMES are dropped here
+    M: world -> pixel affine from topdown_affine()
+    render_scale < 1 rasterizes grid + trails at reduced resolution and upscales once;
+    markers and labels are always drawn at full resolution so they stay crisp.
+    """
+    H, W = panel_h, panel_w
+    s = render_scale
+    if s != 1.0:
+        h, w = max(1, int(H * s)), max(1, int(W * s))
+        img = _render_trail_layer(h, w, trails, (M * s).astype(np.float32), cur_frame, s)
+        img = cv2.resize(img, (W, H), interpolation=cv2.INTER_LINEAR)
+    else:
+        img = _render_trail_layer(H, W, trails, M, cur_frame, 1.0)
+
+    # current positions + labels
+    obj_px = world_to_px(M, np.array([[o["Xw"], o["Yw"]] for o in objects], dtype=np.float32).reshape(-1, 2))
+    for o, (u, v) in zip(objects, obj_px.tolist()):
+        col = color_for_id(o["gid"])
+        cv2.circle(img, (u, v), 6, col, -1, cv2.LINE_AA)
+        label = f'{o["label"]} id:{o["gid"]}'
+        draw_label(img, label, (u+8, v-6), 0.5, (255,255,255), (10,10,10), FONT)
+
+    cv2.putText(img, "Top-down (X-Y)", (8, 22), FONT, 0.6, (220,220,220), 1, cv2.LINE_AA)
+    return img
+
+def _render_trail_layer(H, W, trails, M, cur_frame, line_scale):
+    """Background grid + fading trails at (H, W); line widths are scaled by line_scale."""
+    img = np.full((H, W, 3), 18, np.uint8)
 
     # background grid
     for t in np.linspace(0.0, 1.0, 5):
@@ -69,47 +141,88 @@ def render_topdown_panel(panel_h, panel_w, objects, trails, bounds, cur_frame):
         cv2.line(img, (xg, 0), (xg, H-1), (30,30,30), 1)
         cv2.line(img, (0, yg), (W-1, yg), (30,30,30), 1)
 
-    # fade + draw trails (segment-wise)
+    # fade + draw trails (segment-wise, batched per thickness bucket)
     # opacity/thickness decay curve
     max_age = max(1, TRAIL_MAX_AGE_FRAMES)
     gamma   = 1.5  # steeper fade for older segments
-    for gid, q in trails.items():
-        if len(q) < 2:
+    for gid, tb in list(trails.items()):
+        if len(tb) == 0 or cur_frame - tb.newest_frame() > TRAIL_MAX_AGE_FRAMES:
+            del trails[gid]  # fully faded; old rows inside live buffers are masked by age below
+            continue
+        if len(tb) < 2:
+            continue
+        arr = tb.view()  # (N, 3): Xw, Yw, frame relative to tb.base
+        now = cur_frame - tb.base
+        base_col = GID_PALETTE[gid % len(GID_PALETTE)].astype(np.float32)
+
+        # per-segment age, using the newer endpoint; a segment whose older endpoint
+        # has aged out is dropped too (replaces the old per-frame popleft pruning)
+        age = now - arr[1:, 2]
+        live = (age >= 0) & (now - arr[:-1, 2] <= TRAIL_MAX_AGE_FRAMES)
+        if not live.any():
             continue
-        base_col = np.array(color_for_id(gid), dtype=np.float32)
-
-        # walk consecutive pairs
-        for i in range(1, len(q)):
-            (x1, y1, f1) = q[i-1]
-            (x2, y2, f2) = q[i]
-            age = cur_frame - f2  # use newer endpoint’s age
-            if age < 0 or age > TRAIL_MAX_AGE_FRAMES:
-                continue
-
-            # 0 (old) -> 1 (fresh)
-            t = 1.0 - (age / max_age)
-            t = max(0.0, min(1.0, t)) ** gamma
-
-            # fade color & thickness
-            col = (base_col * (0.35 + 0.65 * t)).astype(np.int32)  # keep some visibility when recent
-            thick = max(1, int(round(4 * t)))  # 1..4 px
 
-            u1, v1 = world_to_px(x1, y1)
-            u2, v2 = world_to_px(x2, y2)
-            cv2.line(img, (u1, v1), (u2, v2), tuple(int(c) for c in col.tolist()), thick, cv2.LINE_AA)
+        # 0 (old) -> 1 (fresh)
+        t = np.clip(1.0 - age / max_age, 0.0, 1.0) ** gamma
+        thick = np.clip(np.rint(4 * t).astype(np.int32), 1, 4)  # 1..4 px
 
-    # current positions + labels
-    for o in objects:
-        u, v = world_to_px(o["Xw"], o["Yw"])
-        col = color_for_id(o["gid"])
-        cv2.circle(img, (u, v), 6, col, -1, cv2.LINE_AA)
-        label = f'{o["label"]} id:{o["gid"]}'
-        cv2.putText(img, label, (u+8, v-6), FONT, 0.5, (10,10,10), 2, cv2.LINE_AA)
-        cv2.putText(img, label, (u+8, v-6), FONT, 0.5, (255,255,255), 1, cv2.LINE_AA)
+        pts = world_to_px(M, arr[:, :2])
+        segs = np.stack([pts[:-1], pts[1:]], axis=1)  # (N-1, 2, 2)
 
-    cv2.putText(img, "Top-down (X-Y)", (8, 22), FONT, 0.6, (220,220,220), 1, cv2.LINE_AA)
+        # one polylines call per thickness bucket; the bucket doubles as a coarse fade bin
+        for th in range(1, 5):
+            sel = live & (thick == th)
+            if not sel.any():
+                continue
+            col = base_col * (0.35 + 0.65 * float(t[sel].mean()))  # keep some visibility when recent
+            cv2.polylines(img, list(segs[sel]), False, tuple(int(c) for c in col),
+                          max(1, int(round(th * line_scale))), cv2.LINE_AA)
     return img
 
+class LatestFrame:
+    """
+    Newest-wins handoff between a webcam capture thread and the inference loop.
+    The capture thread keeps reading at camera rate and overwrites the single slot,
+    so inference always gets the freshest frame and never waits on (or lags behind) I/O.
+    """
+    def __init__(self, cap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.frame = None
+        self.fresh = False   # slot holds a frame the consumer hasn't taken yet
+        self.ok = True
+        self.stop_evt = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="webcam-capture", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_evt.is_set():
+            ok, frame = self.cap.read()  # fresh array per read, so handing off the reference is safe
+            with self.cond:
+                if not ok:
+                    self.ok = False
+                else:
+                    self.frame, self.fresh = frame, True
+                self.cond.notify()
+            if not ok:
+                break
+
+    def read(self, timeout: float = 1.0):
+        """Wait for a frame newer than the last one returned. Returns (ok, frame)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.fresh or not self.ok, timeout)
+            if not self.fresh:
+                return False, None
+            self.fresh = False
+            return True, self.frame
+
+    def stop(self):
+        self.stop_evt.set()
+        self.thread.join(timeout=1.0)
+
 def get_res_for_id(client_id):
     """
     Fetch the latest frame for the given client_id and run YOLO object detection on it.
@@ -132,18 +245,8 @@ def get_res_for_id(client_id):
             print(f"[ERROR] No frame available for client {client_id}: Frame fetch returned None")
             raise ValueError(f"No frame available for client {client_id}: Unknown error")
         
-        print(f"[DEBUG] Frame fetched successfully for client {client_id}, size: {frame.size}, mode: {frame.mode}")
-        
-        # Convert PIL Image to numpy array (BGR for OpenCV)
-        frame_np = np.array(frame)
-        if frame.mode == 'RGB':
-            frame_np = cv2.cvtColor(frame_np, cv2.COLOR_RGB2BGR)
-            print(f"[DEBUG] Converted RGB to BGR for client {client_id}")
-        elif frame.mode == 'RGBA':
-            frame_np = cv2.cvtColor(frame_np, cv2.COLOR_RGBA2BGR)
-            print(f"[DEBUG] Converted RGBA to BGR for client {client_id}")
-        # Assume it's already BGR if not RGB
-        
+        # get_frame already decodes to a BGR ndarray
+        frame_np = frame
         print(f"[DEBUG] Frame shape: {frame_np.shape} for client {client_id}")
         
         # Use the global YOLOE processor instance to maintain tracking state
@@ -169,6 +272,22 @@ def get_res_for_id(client_id):
         traceback.print_exc()
         raise
 
+def get_res_for_frames(frames):
+    """
+    Run YOLO detection on several already-fetched frames in one batched forward pass.
+    
+    Args:
+        frames (list): BGR ndarrays (e.g. the latest frame of several clients)
+        
+    Returns:
+        list: One detection list per input frame, in input order
+    """
+    with _rt_lock:
+        rt = get_global_rt()
+        results = rt.process_frames(frames, return_vis=False)
+    print(f"[DEBUG] Batched YOLO processing complete for {len(frames)} frames, current frame index: {rt.frame_idx}")
+    return [json_list for json_list, _ in results]
+
 def main():
     rt = YoloeRealtime(weights="yoloe-11s-seg.pt", device=0)  # set device=None for CPU
 
@@ -180,13 +299,15 @@ def main():
 
     cv2.namedWindow(WIN, cv2.WINDOW_NORMAL)
 
-    # trails: gid -> deque[(Xw, Yw, frame_idx)]
-    trails = defaultdict(lambda: deque(maxlen=TRAIL_CAP_PER_OBJ))
+    # trails: gid -> TrailBuf of (Xw, Yw, frame_idx)
+    trails = defaultdict(TrailBuf)
 
     # dynamic bounds
     have_bounds = False
     xmin = ymin = float("inf")
     xmax = ymax = float("-inf")
+    M = None; last_bounds_key = None  # world -> pixel affine, rebuilt when bounds change
+    panel2d = None; last_panel_key = None  # last rendered top-down panel and what it showed
 
     # prime
     ok, frame = cap.read()
@@ -197,8 +318,17 @@ def main():
     PANEL_W = H  # square panel
     frame_idx = 0
 
+    # composition buffers, allocated once and overwritten in place every frame
+    out_h = H; out_w = W + PANEL_W
+    y0 = (out_h - PANEL_H) // 2
+    canvas = np.zeros((out_h, out_w, 3), dtype=np.uint8)
+    disp_size = (int(round(out_w * DISPLAY_SCALE)), int(round(out_h * DISPLAY_SCALE)))
+    disp = np.empty((disp_size[1], disp_size[0], 3), dtype=np.uint8) if DISPLAY_SCALE != 1.0 else canvas
+
+    grabber = LatestFrame(cap).start()
+
     while True:
-        ok, frame = cap.read()
+        ok, frame = grabber.read()
         if not ok:
             break
 
@@ -216,17 +346,11 @@ def main():
             label = str(obj["label"])
             xw = float(Xw); yw = float(Yw)
             objs.append({"gid": gid, "label": label, "Xw": xw, "Yw": yw})
-            trails[gid].append((xw, yw, frame_idx))
+            trails[gid].append(xw, yw, frame_idx)
             xmin = min(xmin, xw); xmax = max(xmax, xw)
             ymin = min(ymin, yw); ymax = max(ymax, yw)
             have_bounds = True
 
-        # prune old points globally (keeps UI clean even when idle)
-        cutoff = frame_idx - TRAIL_MAX_AGE_FRAMES
-        for gid, q in list(trails.items()):
-            while q and q[0][2] < cutoff:
-                q.popleft()
-
         # fallback bounds until we have data
         if not have_bounds:
             xmin = ymin = -1.0; xmax = ymax = 1.0
@@ -235,23 +359,31 @@ def main():
             "xmin": xmin - MAP_PAD, "xmax": xmax + MAP_PAD,
             "ymin": ymin - MAP_PAD, "ymax": ymax + MAP_PAD
         }
-
-        # render top-down
-        panel2d = render_topdown_panel(PANEL_H, PANEL_W, objs, trails, bounds, frame_idx)
+        bounds_key = (bounds["xmin"], bounds["xmax"], bounds["ymin"], bounds["ymax"])
+        if bounds_key != last_bounds_key:
+            M = topdown_affine(PANEL_H, PANEL_W, bounds)
+            last_bounds_key = bounds_key
+
+        # render top-down, unless nothing moved since the last render in this fade bucket
+        panel_key = (
+            frozenset((o["gid"], o["label"], round(o["Xw"], 3), round(o["Yw"], 3)) for o in objs),
+            bounds_key, frame_idx // PANEL_REUSE_FRAMES,
+        )
+        if panel_key != last_panel_key:
+            rscale = PANEL_RENDER_SCALE if len(trails) >= PANEL_SCALE_MIN_TRAILS else 1.0
+            panel2d = render_topdown_panel(PANEL_H, PANEL_W, objs, trails, M, frame_idx, rscale)
+            last_panel_key = panel_key
 
         # compose [camera | top-down]
-        out_h = H; out_w = W + PANEL_W
-        canvas = np.zeros((out_h, out_w, 3), dtype=np.uint8)
         canvas[:, :W] = vis
-        y0 = (out_h - PANEL_H) // 2
         canvas[y0:y0+PANEL_H, W:W+PANEL_W] = panel2d
 
         # header
         cv2.rectangle(canvas, (0,0), (out_w, 34), (0,0,0), -1)
         cv2.putText(canvas, "Live: Camera | Top-down (fading trails)", (12, 22), FONT, 0.7, (255,255,255), 1, cv2.LINE_AA)
 
-        disp = cv2.resize(canvas, None, fx=DISPLAY_SCALE, fy=DISPLAY_SCALE, interpolation=cv2.INTER_AREA) \
-               if DISPLAY_SCALE != 1.0 else canvas
+        if DISPLAY_SCALE != 1.0:
+            cv2.resize(canvas, disp_size, dst=disp, interpolation=cv2.INTER_AREA)
         cv2.imshow(WIN, disp)
 
         # optional: print JSON
@@ -263,6 +395,7 @@ def main():
 
         frame_idx += 1
 
+    grabber.stop()
     cap.release()
     cv2.destroyAllWindows()
 
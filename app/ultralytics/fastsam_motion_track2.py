@@ -5,9 +5,13 @@
 
 import csv
 import cv2
+import os
+import threading
+import numpy as np
 from pathlib import Path
 
 from yoloe_rt import YoloeRealtime  # <-- our module
+from vis_utils import open_video_writer
 
 # ---------------- Config ----------------
 VIDEO_PATH = "test_videos/test_video21.mp4"
@@ -17,8 +21,105 @@ OUT_MP4    = OUT_DIR / "annotated.mp4"
 
 WEIGHTS    = "yoloe-11s-seg.pt"
 DEVICE     = 0            # None for CPU
-SHOW_WIN   = True         # preview while processing
+SHOW_WIN   = os.getenv("SHOW", "0") == "1"  # preview while processing; off for headless runs
+CSV_BUFFER_BYTES = 1 << 20  # large write buffer: rows hit disk in ~1 MiB chunks, not per frame
 WIN_NAME   = "YOLOE • Video via Module"
+DISPLAY_SCALE = 0.5       # preview is a downsampled copy; the MP4 keeps full resolution
+HW_ENCODE  = True         # try NVENC through GStreamer first, fall back to software mp4v
+
+# ---------------- Pipeline plumbing ----------------
+class DoubleBuffer:
+    """
+    Two-slot handoff between exactly one producer and one consumer thread.
+    The producer fills one slot while the consumer drains the other, then both swap.
+    Per slot, `ready` = filled and `free` = drained. None is the end-of-stream marker.
+    """
+    def __init__(self, stop: threading.Event):
+        self.stop = stop
+        self.slots = [None, None]
+        self.ready = [threading.Event(), threading.Event()]
+        self.free  = [threading.Event(), threading.Event()]
+        for e in self.free:
+            e.set()
+        self.w = 0; self.r = 0   # producer / consumer slot pointers
+
+    def put(self, item) -> bool:
+        while not self.free[self.w].wait(0.1):
+            if self.stop.is_set():
+                return False
+        self.free[self.w].clear()
+        self.slots[self.w] = item
+        self.ready[self.w].set()
+        self.w ^= 1
+        return True
+
+    def get(self):
+        while not self.ready[self.r].wait(0.1):
+            if self.stop.is_set():
+                return None
+        self.ready[self.r].clear()
+        item, self.slots[self.r] = self.slots[self.r], None
+        self.free[self.r].set()
+        self.r ^= 1
+        return item
+
+def _read_frames(cap, out: DoubleBuffer):
+    """Stage A: decode frames from the video."""
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok or not out.put(frame):
+                break
+    finally:
+        out.put(None)
+
+def _infer_frames(rt: YoloeRealtime, inp: DoubleBuffer, out: DoubleBuffer):
+    """Stage B: YOLOE + IDs + 3D via the module, plus the info strip."""
+    try:
+        while True:
+            frame = inp.get()
+            if frame is None:
+                break
+
+            # Process with module (returns JSON list + annotated image)
+            json_list, vis = rt.process_frame(frame, return_vis=True)
+            if vis is None:
+                vis = frame
+
+            # (Optional) tiny info strip
+            if rt.fx is not None and rt.fy is not None:
+                cv2.rectangle(vis, (8,8), (8+560, 8+64), (0,0,0), -1)
+                cv2.putText(vis, "YOLOE promptable seg + GlobalIDs + 3D (via module)",
+                            (14,30), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255,255,255), 1, cv2.LINE_AA)
+                fx_txt = f"fx={rt.fx:.1f}, fy={rt.fy:.1f}, pitch={rt.cam_pitch_deg:.1f}°, h={rt.cam_height_m:.2f}m"
+                cv2.putText(vis, fx_txt, (14, 52), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (220,220,220), 1, cv2.LINE_AA)
+
+            if not out.put((json_list, vis)):
+                break
+    finally:
+        out.put(None)
+
+def _write_frames(writer, inp: DoubleBuffer):
+    """Stage C: encode annotated frames, off the display/CSV thread."""
+    while True:
+        vis = inp.get()
+        if vis is None:
+            break
+        writer.write(vis)
+
+def _nz(x):
+    """None → "" for CSV."""
+    return "" if x is None else x
+
+def csv_row(obj):
+    """One detections.csv row for a process_frame JSON object."""
+    return [
+        obj["frame"], obj["global_id"], obj["label"],
+        obj["x1"], obj["y1"], obj["x2"], obj["y2"],
+        f'{obj["cx"]:.2f}', f'{obj["cy"]:.2f}',
+        _nz(obj.get("Xc")), _nz(obj.get("Yc")), _nz(obj.get("Zc")),
+        _nz(obj.get("Xw")), _nz(obj.get("Yw")), _nz(obj.get("Zw")),
+    ]
 
 # ---------------- Main ----------------
 def main():
@@ -35,65 +136,67 @@ def main():
     FPS = cap.get(cv2.CAP_PROP_FPS) or 30.0
 
     # 3) Video writer
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    writer = cv2.VideoWriter(str(OUT_MP4), fourcc, FPS, (W, H))
+    writer = open_video_writer(OUT_MP4, FPS, (W, H), hw=HW_ENCODE)
 
     # 4) CSV writer (same columns/order as your original)
     new_file = not CSV_PATH.exists()
-    fcsv = open(CSV_PATH, "w", newline="")  # fresh file each run
+    fcsv = open(CSV_PATH, "w", newline="", buffering=CSV_BUFFER_BYTES)  # fresh file each run; flushed on close
     wcsv = csv.writer(fcsv)
     wcsv.writerow([
         "frame","global_id","label","x1","y1","x2","y2","cx","cy",
         "Xc","Yc","Zc","Xw","Yw","Zw"
     ])
 
+    disp_size = (max(1, int(W * DISPLAY_SCALE)), max(1, int(H * DISPLAY_SCALE)))
+    disp = np.empty((disp_size[1], disp_size[0], 3), np.uint8)  # reused preview buffer
     if SHOW_WIN:
         cv2.namedWindow(WIN_NAME, cv2.WINDOW_NORMAL)
-        cv2.resizeWindow(WIN_NAME, W, H)
+        cv2.resizeWindow(WIN_NAME, *disp_size)
+
+    # 5) Reader -> inference -> (this thread) CSV/display -> encoder, double-buffered between stages.
+    #    Display stays on the main thread because cv2.waitKey/imshow must.
+    stop = threading.Event()
+    frames_q = DoubleBuffer(stop)
+    results_q = DoubleBuffer(stop)
+    encode_q = DoubleBuffer(stop)
+    workers = [
+        threading.Thread(target=_read_frames, args=(cap, frames_q), name="reader", daemon=True),
+        threading.Thread(target=_infer_frames, args=(rt, frames_q, results_q), name="infer", daemon=True),
+        threading.Thread(target=_write_frames, args=(writer, encode_q), name="encoder", daemon=True),
+    ]
+    for t in workers:
+        t.start()
 
     frame_idx = 0
     try:
         while True:
-            ok, frame = cap.read()
-            if not ok:
+            item = results_q.get()
+            if item is None:
                 break
+            json_list, vis = item
 
-            # 5) Process with module (returns JSON list + annotated image)
-            json_list, vis = rt.process_frame(frame, return_vis=True)
-            if vis is None:
-                vis = frame
-
-            # 6) (Optional) tiny info strip
-            if rt.fx is not None and rt.fy is not None:
-                cv2.rectangle(vis, (8,8), (8+560, 8+64), (0,0,0), -1)
-                cv2.putText(vis, "YOLOE promptable seg + GlobalIDs + 3D (via module)",
-                            (14,30), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255,255,255), 1, cv2.LINE_AA)
-                fx_txt = f"fx={rt.fx:.1f}, fy={rt.fy:.1f}, pitch={rt.cam_pitch_deg:.1f}°, h={rt.cam_height_m:.2f}m"
-                cv2.putText(vis, fx_txt, (14, 52), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (220,220,220), 1, cv2.LINE_AA)
+            # 6) Hand the annotated frame to the encoder thread (vis is read-only from here on)
+            if not encode_q.put(vis):
+                break
 
-            # 7) Write annotated frame
-            writer.write(vis)
-
-            # 8) Stream CSV rows (mirrors your original schema)
-            for obj in json_list:
-                # None → "" for CSV
-                def nz(x): return "" if x is None else x
-                wcsv.writerow([
-                    obj["frame"], obj["global_id"], obj["label"],
-                    obj["x1"], obj["y1"], obj["x2"], obj["y2"],
-                    f'{obj["cx"]:.2f}', f'{obj["cy"]:.2f}',
-                    nz(obj.get("Xc")), nz(obj.get("Yc")), nz(obj.get("Zc")),
-                    nz(obj.get("Xw")), nz(obj.get("Yw")), nz(obj.get("Zw")),
-                ])
+            # 7) Stream CSV rows (mirrors your original schema), one writerows call per frame
+            wcsv.writerows([csv_row(obj) for obj in json_list])
 
             if SHOW_WIN:
-                cv2.imshow(WIN_NAME, vis)
+                cv2.resize(vis, disp_size, dst=disp, interpolation=cv2.INTER_AREA)
+                cv2.imshow(WIN_NAME, disp)
                 if cv2.waitKey(1) & 0xFF == 27:
                     break
 
             frame_idx += 1
 
     finally:
+        if workers[2].is_alive():
+            encode_q.put(None)   # let the encoder drain pending frames before stopping the pipeline
+            workers[2].join()
+        stop.set()
+        for t in workers:
+            t.join(timeout=5.0)
         cap.release()
         writer.release()
         fcsv.close()
@@ -1,13 +1,55 @@
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-from PIL import Image
-from io import BytesIO
-from typing import List, Optional
+try:
+    import pybase64 as _b64  # SIMD decoder, drop-in compatible
+except ImportError:
+    _b64 = base64
+import cv2
+import numpy as np
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR  # optional: faster JPEG decode straight to BGR
+    _TJ = TurboJPEG()
+except Exception:   # module missing, or libturbojpeg not found
+    _TJ = None
+from typing import Dict, List, Optional
 import json
+import threading
+import logging
 
 # Default API base URL - can be overridden
 DEFAULT_API_URL = "https://demo8080.shivi.io/api"
 
+# Quiet by default (WARNING via the root logger); enable DEBUG to trace every request
+logger = logging.getLogger(__name__)
+
+# Shared keep-alive session: frames are polled in a loop, so reuse TCP/TLS connections
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()   # fetches may run on worker threads (see aget_frame)
+
+def _session() -> requests.Session:
+    """Return the module-wide pooled session, creating it on first use."""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                      max_retries=Retry(total=2, backoff_factor=0.1))
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _SESSION = s
+    return _SESSION
+
+def close_session() -> None:
+    """Close pooled connections (call on shutdown)."""
+    global _SESSION
+    if _SESSION is not None:
+        _SESSION.close()
+        _SESSION = None
+
 def get_clients(api_url: str = DEFAULT_API_URL) -> List[str]:
     """
     Get list of all connected client IDs from the Golang backend.
@@ -22,121 +64,153 @@ def get_clients(api_url: str = DEFAULT_API_URL) -> List[str]:
         requests.RequestException: If API request fails
         ValueError: If API response is invalid
     """
-    print(f"[DEBUG] Fetching clients from {api_url}")
-    
     try:
         url = f"{api_url}/clients"
-        print(f"[DEBUG] Making GET request to: {url}")
-        response = requests.get(url, timeout=5)
-        print(f"[DEBUG] Response status code: {response.status_code}")
+        logger.debug("GET %s", url)
+        response = _session().get(url, timeout=5)
+        logger.debug("Response status code: %s", response.status_code)
         response.raise_for_status()
         
-        print(f"[DEBUG] Parsing JSON response")
         data = response.json()
         
         if isinstance(data, dict):
             if not data.get("success", False):
                 error_msg = data.get("error", "Unknown error")
-                print(f"[ERROR] API error fetching clients: {error_msg}")
+                logger.error("API error fetching clients: %s", error_msg)
                 raise ValueError(f"API error: {error_msg}")
             clients = data.get("clients", [])
         else:
             # Backend returns list directly
             clients = data if isinstance(data, list) else []
         
-        print(f"[DEBUG] Found {len(clients)} clients: {clients}")
+        logger.debug("Found %d clients: %s", len(clients), clients)
         return clients
         
     except requests.RequestException as e:
-        print(f"[ERROR] Request exception fetching clients: {e}")
-        print(f"[DEBUG] Exception type: {type(e).__name__}")
+        logger.error("Request exception fetching clients: %s (%s)", e, type(e).__name__)
         return []
     except json.JSONDecodeError as e:
-        print(f"[ERROR] JSON decode error fetching clients: {e}")
-        print(f"[DEBUG] Response text: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("JSON decode error fetching clients: %s", e)
+        logger.debug("Response text: %s", response.text)
         return []
-    except Exception as e:
-        print(f"[ERROR] Unexpected exception in get_clients: {e}")
-        print(f"[DEBUG] Exception type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Unexpected exception in get_clients")
         return []
 
-def get_frame(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[Image.Image]:
+def decode_image(buf: bytes) -> Optional[np.ndarray]:
+    """Decode JPEG/PNG bytes to a BGR uint8 ndarray (None if undecodable)."""
+    if _TJ is not None and buf[:2] == b"\xff\xd8":
+        return _TJ.decode(buf, pixel_format=TJPF_BGR)
+    return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+
+# API base URLs whose backend predates the raw /latest.jpg endpoint
+_NO_RAW_ENDPOINT: set = set()
+
+def get_frame_raw(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[np.ndarray]:
+    """
+    Get the latest frame for a client from the raw-bytes endpoint (/clients/{id}/latest.jpg).
+    Skips the JSON envelope and base64 decode of get_frame's legacy path.
+
+    Returns:
+        BGR ndarray, or None if the endpoint returned 404 (no frame, or older backend)
+
+    Raises:
+        requests.RequestException: If API request fails for another reason
+        IOError: If the body is not a decodable image
+    """
+    response = _session().get(f"{api_url}/clients/{client_id}/latest.jpg", timeout=5)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    image = decode_image(response.content)
+    if image is None:
+        raise IOError(f"undecodable frame from {response.url}")
+    return image
+
+def get_frame(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[np.ndarray]:
     """
     Get the latest frame (image) for a specific client ID.
+    Prefers the raw JPEG endpoint and falls back to the JSON+base64 one when the raw
+    route 404s or returns an undecodable body; request errors return None without a retry.
     
     Args:
         client_id: The client ID to fetch frame for
         api_url: Base URL of the SkySentry API (default: https://demo8080.shivi.io/api)
         
     Returns:
-        PIL Image object if successful, None if no frame available or error
+        BGR uint8 ndarray (H, W, 3) if successful, None if no frame available or error
         
     Raises:
         requests.RequestException: If API request fails
         ValueError: If API response is invalid
     """
-    print(f"[DEBUG] Fetching frame for client {client_id} from {api_url}")
-    
+    raw_missing = False
+    if api_url not in _NO_RAW_ENDPOINT:
+        try:
+            image = get_frame_raw(client_id, api_url)
+            if image is not None:
+                return image
+            raw_missing = True
+        except requests.RequestException as e:
+            # Transport error or 5xx: the JSON route is on the same host, so don't pay for a second failure
+            logger.error("Raw frame fetch failed for client %s: %s (%s)", client_id, e, type(e).__name__)
+            return None
+        except IOError as e:  # undecodable body (RequestException subclasses IOError, so it is caught above)
+            logger.error("Raw frame fetch failed for client %s: %s", client_id, e)
+
     try:
         url = f"{api_url}/clients/{client_id}/latest"
-        print(f"[DEBUG] Making GET request to: {url}")
-        response = requests.get(url, timeout=5)
-        print(f"[DEBUG] Response status code: {response.status_code}")
+        logger.debug("GET %s", url)
+        response = _session().get(url, timeout=5)
+        logger.debug("Response status code: %s", response.status_code)
         response.raise_for_status()
         
-        print(f"[DEBUG] Parsing JSON response for client {client_id}")
         data = response.json()
-        print(f"[DEBUG] Response data keys: {list(data.keys()) if isinstance(data, dict) else 'Not a dict'}")
         
         # Check if image data is present (backend doesn't send 'success' field)
         if "image" not in data or not data.get("image"):
-            print(f"[ERROR] No image data in response for client {client_id}")
-            print(f"[DEBUG] Full response data: {data}")
+            logger.error("No image data in response for client %s", client_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response keys: %s", list(data.keys()) if isinstance(data, dict) else type(data).__name__)
             return None
             
         # Extract base64 image data
         image_data = data.get("image")
-        print(f"[DEBUG] Image data length: {len(image_data)} for client {client_id}")
-        
-        # Remove data URL prefix if present (data:image/jpeg;base64,)
-        if image_data.startswith("data:image/jpeg;base64,"):
-            image_data = image_data.split(",", 1)[1]
-            print(f"[DEBUG] Removed data URL prefix for JPEG")
-        elif image_data.startswith("data:image/png;base64,"):
-            image_data = image_data.split(",", 1)[1]
-            print(f"[DEBUG] Removed data URL prefix for PNG")
-            
-        print(f"[DEBUG] Decoding base64 for client {client_id}")
-        image_bytes = base64.b64decode(image_data)
-        print(f"[DEBUG] Decoded bytes length: {len(image_bytes)}")
         
-        print(f"[DEBUG] Opening image with PIL for client {client_id}")
-        image = Image.open(BytesIO(image_bytes))
-        print(f"[DEBUG] Image opened: size={image.size}, mode={image.mode}")
+        # Remove data URL prefix if present (data:image/jpeg;base64, / data:image/png;base64,);
+        # the comma is searched for in the first few bytes only and the payload is sliced once
+        start = 0
+        if image_data.startswith("data:"):
+            start = image_data.find(",", 0, 32) + 1
+            
+        # Raw endpoint 404'd but the JSON one has a frame: backend has no raw route, stop trying it
+        if raw_missing:
+            _NO_RAW_ENDPOINT.add(api_url)
+
+        image_bytes = _b64.b64decode(image_data[start:] if start else image_data)
+        image = decode_image(image_bytes)
+        if image is None:
+            logger.error("Image decode error for client %s", client_id)
+            return None
+        logger.debug("Frame for client %s: %d bytes, shape=%s", client_id, len(image_bytes), image.shape)
         
         return image
         
     except requests.RequestException as e:
-        print(f"[ERROR] Request exception fetching frame for client {client_id}: {e}")
-        print(f"[DEBUG] Exception type: {type(e).__name__}")
+        logger.error("Request exception fetching frame for client %s: %s (%s)", client_id, e, type(e).__name__)
         return None
     except json.JSONDecodeError as e:
-        print(f"[ERROR] JSON decode error for client {client_id}: {e}")
-        print(f"[DEBUG] Response text: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("JSON decode error for client %s: %s", client_id, e)
+        logger.debug("Response text: %s", response.text)
         return None
     except base64.binascii.Error as e:
-        print(f"[ERROR] Base64 decode error for client {client_id}: {e}")
+        logger.error("Base64 decode error for client %s: %s", client_id, e)
         return None
     except IOError as e:
-        print(f"[ERROR] Image processing error for client {client_id}: {e}")
+        logger.error("Image processing error for client %s: %s", client_id, e)
         return None
-    except Exception as e:
-        print(f"[ERROR] Unexpected exception in get_frame for client {client_id}: {e}")
-        print(f"[DEBUG] Exception type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Unexpected exception in get_frame for client %s", client_id)
         return None
 
 def get_frame_info(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[dict]:
@@ -151,7 +225,7 @@ def get_frame_info(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[d
         Dictionary with frame metadata (timestamp, size, stats) if successful, None otherwise
     """
     try:
-        response = requests.get(f"{api_url}/clients/{client_id}/latest", timeout=5)
+        response = _session().get(f"{api_url}/clients/{client_id}/latest", timeout=5)
         response.raise_for_status()
         
         data = response.json()
@@ -167,32 +241,53 @@ def get_frame_info(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[d
         }
         
     except (requests.RequestException, json.JSONDecodeError) as e:
-        print(f"Error fetching frame info for client {client_id}: {e}")
+        logger.error("Error fetching frame info for client %s: %s", client_id, e)
         return None
 
+async def aget_frame(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[np.ndarray]:
+    """get_frame on a worker thread, so several clients can be fetched concurrently."""
+    return await asyncio.to_thread(get_frame, client_id, api_url)
+
+async def aget_frame_info(client_id: str, api_url: str = DEFAULT_API_URL) -> Optional[dict]:
+    """get_frame_info on a worker thread."""
+    return await asyncio.to_thread(get_frame_info, client_id, api_url)
+
+async def aget_all_frames(client_ids: List[str], api_url: str = DEFAULT_API_URL) -> Dict[str, Optional[np.ndarray]]:
+    """
+    Latest frame for every client, fetched concurrently over the pooled session
+    (wall time ~ slowest round-trip instead of the sum). Returns client_id -> frame or None.
+    """
+    frames = await asyncio.gather(*(aget_frame(c, api_url) for c in client_ids))
+    return dict(zip(client_ids, frames))
+
 # Example usage
-if __name__ == "__main__":
-    # Test the functions
+async def main_async():
     print("Testing SkySentry frame fetching...")
     
     # Get all clients
     clients = get_clients()
     print(f"Found {len(clients)} clients: {clients}")
     
-    # Try to get frame for each client
-    for client_id in clients:
-        print(f"\nFetching frame for client: {client_id}")
-        
-        # Get frame info
-        info = get_frame_info(client_id)
+    # Fetch info + frame for every client concurrently
+    infos, frames = await asyncio.gather(
+        asyncio.gather(*(aget_frame_info(c) for c in clients)),
+        aget_all_frames(clients),
+    )
+    for client_id, info in zip(clients, infos):
+        print(f"\nClient: {client_id}")
         if info:
             print(f"  Timestamp: {info['timestamp']}")
             print(f"  Size: {info['size']} bytes")
             print(f"  Stats: {info['stats']}")
         
-        # Get actual frame
-        frame = get_frame(client_id)
-        if frame:
-            print(f"  Image: {frame.size} pixels, mode: {frame.mode}")
+        frame = frames[client_id]
+        if frame is not None:
+            print(f"  Image: {frame.shape[1]}x{frame.shape[0]} pixels, BGR")
         else:
-            print(f"  No frame available")
\ No newline at end of file
+            print(f"  No frame available")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main_async())
+    finally:
+        close_session()
@@ -2,20 +2,42 @@
 # pip install --upgrade ultralytics opencv-python
 import cv2
 import json
+import os
+import queue
+import sys
+import threading
 import time
+import hashlib
+from pathlib import Path
 import math
 import numpy as np
-from typing import List, Dict, Tuple, Any, Optional
+import torch
+import torch.nn.functional as F
+from collections import deque
+from functools import lru_cache
+from typing import List, Dict, Tuple, Any, Optional, Deque
 from ultralytics import YOLOE
 
+from vis_utils import GID_PALETTE, color_for_gid
+
+try:
+    import orjson  # optional: much faster serializer, bytes out
+except ImportError:
+    orjson = None
+
 # ---------------- Config ----------------
 WEIGHTS    = "yoloe-11s-seg.pt"     # or yoloe-11m-seg.pt / yoloe-11l-seg.pt
 DEVICE     = 0                      # None for CPU; or GPU index (e.g., 0)
-IMGSZ      = 960
+MODEL_STRIDE = 32
+IMGSZ      = -(-960 // MODEL_STRIDE) * MODEL_STRIDE   # 960 rounded up to the stride once, so no per-call rounding/warnings
+GPU_PREPROCESS = True               # on CUDA: letterbox + normalize on the GPU and feed predict() a tensor
+USE_TENSORRT = True                 # on CUDA: build (once) and run an FP16 TensorRT engine with the prompts baked in
 CONF       = 0.15
 IOU        = 0.5
 CAM_INDEX  = 0                      # default webcam
 WINDOW_NAME = "YOLOE • Live • IDs + 3D"
+SHOW       = os.getenv("SHOW", "0") == "1"  # preview window + overlay drawing; off for headless runs
+JSON_QUEUE_SIZE = 64                # frames of JSON buffered for stdout; newer frames are dropped when full
 
 CLASSES = [
     "white bottle", "paper sign in hand", "paper air plane",
@@ -50,101 +72,143 @@ HFOV_DEG = 66.5
 VFOV_DEG = 52.6
 
 # ---------------- Small utils ----------------
-def color_for_gid(gid: int) -> Tuple[int, int, int]:
-    return (
-        60 + (37 * (gid + 1)) % 195,
-        60 + (91 * (gid + 1)) % 195,
-        60 + (13 * (gid + 1)) % 195,
-    )
-
 def prepare_prompts(model: YOLOE, classes: List[str]) -> None:
     pe = model.get_text_pe(classes)
     model.set_classes(classes, pe)
 
-def get_masks_resized(r, frame_hw: Tuple[int, int]) -> List[np.ndarray]:
+class GpuLetterbox:
+    """
+    Letterbox a BGR uint8 frame into a reused (1, 3, h, w) float tensor on the GPU, matching
+    ultralytics' LetterBox geometry (minimal stride padding, or a full square for static engines).
+    The frame goes up as uint8 through a pinned buffer; flip/resize/normalize run on device.
+    predict() then reports boxes and masks in letterboxed coordinates; the helpers below map back.
+    """
+    def __init__(self, frame_hw: Tuple[int, int], imgsz: int, device, square: bool, stride: int = 32):
+        H, W = frame_hw
+        self.r = min(imgsz / H, imgsz / W)
+        self.nh, self.nw = int(round(H * self.r)), int(round(W * self.r))
+        hp, wp = (imgsz, imgsz) if square else (self.nh + (imgsz - self.nh) % stride, self.nw + (imgsz - self.nw) % stride)
+        self.top = int(round((hp - self.nh) / 2 - 0.1))
+        self.left = int(round((wp - self.nw) / 2 - 0.1))
+        self.host = torch.empty((H, W, 3), dtype=torch.uint8).pin_memory()
+        self.out = torch.full((1, 3, hp, wp), 114 / 255.0, dtype=torch.float32, device=device)
+        self.offset = torch.tensor([self.left, self.top, self.left, self.top], dtype=torch.float32, device=device)
+
+    def __call__(self, frame: np.ndarray) -> torch.Tensor:
+        self.host.numpy()[...] = frame
+        x = self.host.to(self.out.device, non_blocking=True).permute(2, 0, 1).flip(0)[None].float()
+        x = F.interpolate(x, size=(self.nh, self.nw), mode="bilinear", align_corners=False)
+        self.out[:, :, self.top:self.top + self.nh, self.left:self.left + self.nw] = x.div_(255.0)
+        return self.out
+
+    def boxes_to_frame(self, xyxy: torch.Tensor) -> torch.Tensor:
+        return (xyxy - self.offset.to(xyxy.device)) / self.r
+
+    def crop_masks(self, m: torch.Tensor) -> torch.Tensor:
+        return m[:, self.top:self.top + self.nh, self.left:self.left + self.nw]
+
+def get_masks_resized(r, frame_hw: Tuple[int, int], lb: Optional[GpuLetterbox] = None) -> np.ndarray:
+    """
+    All instance masks as one (N, H, W) bool array at frame resolution.
+    Resized in one batched nearest-neighbour interpolate on the masks' device (GPU when
+    inference ran there); only the final bool stack is copied to host.
+    lb: the letterbox the input went through, if predict() was fed a GpuLetterbox tensor.
+    """
     H, W = frame_hw
-    out = []
-    if getattr(r, "masks", None) is not None and r.masks is not None and getattr(r.masks, "data", None) is not None:
-        md = r.masks.data
-        try:
-            md = md.cpu().numpy()
-        except Exception:
-            md = np.array(md)
-        for mi in range(len(md)):
-            m = md[mi] > 0
-            if m.shape != (H, W):
-                m = cv2.resize(m.astype(np.uint8), (W, H), interpolation=cv2.INTER_NEAREST).astype(bool)
-            out.append(m)
-    return out
-
-def parse_detections(r, classes: List[str], frame_hw: Tuple[int, int]) -> List[Dict[str, Any]]:
+    md = getattr(getattr(r, "masks", None), "data", None)
+    if md is None or len(md) == 0:
+        return np.zeros((0, H, W), dtype=bool)
+    if not isinstance(md, torch.Tensor):
+        md = torch.as_tensor(np.asarray(md))
+    m = md > 0
+    if lb is not None:
+        m = lb.crop_masks(m)
+    if tuple(m.shape[1:]) != (H, W):
+        m = F.interpolate(m[:, None].float(), size=(H, W), mode="nearest")[:, 0] > 0.5
+    return m.cpu().numpy()
+
+def parse_detections(r, classes: List[str], frame_hw: Tuple[int, int],
+                     lb: Optional[GpuLetterbox] = None) -> List[Dict[str, Any]]:
     H, W = frame_hw
-    dets: List[Dict[str, Any]] = []
+    # Clamp + filter on the boxes' device, then pull boxes, classes and source indices
+    # to host in one packed copy (a single sync instead of one per tensor)
     if r.boxes is not None and len(r.boxes) > 0:
-        boxes = r.boxes.xyxy.cpu().numpy().astype(int)
-        clss  = r.boxes.cls.cpu().numpy().astype(int) if r.boxes.cls is not None else np.zeros((len(boxes),), int)
+        xyxy = r.boxes.xyxy if lb is None else lb.boxes_to_frame(r.boxes.xyxy)
+        b = xyxy.float().trunc()   # new tensor, so the in-place clamps never touch r.boxes
+        b[:, :2].clamp_(min=0)
+        b[:, 2].clamp_(max=W-1)
+        b[:, 3].clamp_(max=H-1)
+        cls = r.boxes.cls if r.boxes.cls is not None else torch.zeros(len(b), device=b.device)
+        idx = torch.arange(len(b), device=b.device, dtype=b.dtype)
+        packed = torch.cat([b, cls[:, None].to(b.dtype), idx[:, None]], dim=1)
+        packed = packed[(b[:, 2] > b[:, 0]) & (b[:, 3] > b[:, 1])]
+        host = packed.cpu().numpy().astype(int)
+        boxes, cls_idx, keep = host[:, :4], host[:, 4], host[:, 5]
     else:
-        boxes = np.empty((0,4), dtype=int); clss = np.empty((0,), dtype=int)
+        boxes = np.empty((0,4), dtype=int); cls_idx = np.empty((0,), dtype=int); keep = cls_idx
 
-    masks = get_masks_resized(r, (H, W))
+    masks = get_masks_resized(r, (H, W), lb)
+    centers = (boxes[:, :2] + boxes[:, 2:]) * 0.5
 
-    for i, (x1,y1,x2,y2) in enumerate(boxes):
-        x1 = max(0, x1); y1 = max(0, y1); x2 = min(W-1, x2); y2 = min(H-1, y2)
-        if x2 <= x1 or y2 <= y1: continue
-        ci = int(clss[i]) if i < len(clss) else 0
-        label = classes[ci] if 0 <= ci < len(classes) else ""
-        cx, cy = (x1+x2)*0.5, (y1+y2)*0.5
+    dets: List[Dict[str, Any]] = []
+    for i, ci, bbox, center in zip(keep.tolist(), cls_idx.tolist(), boxes.tolist(), centers.tolist()):
         dets.append({
             "cls_idx": ci,
-            "label": label,
-            "bbox": (int(x1), int(y1), int(x2), int(y2)),
-            "center": (float(cx), float(cy)),
+            "label": classes[ci] if 0 <= ci < len(classes) else "",
+            "bbox": tuple(bbox),
+            "center": tuple(center),
             "mask": masks[i] if i < len(masks) else None,
         })
     return dets
 
-def center_dist(a: Tuple[float,float], b: Tuple[float,float]) -> float:
-    ax, ay = a; bx, by = b
-    return float(np.hypot(ax-bx, ay-by))
-
 # --------- Camera math (fx, fy from FOV; 3D estimates) ---------
-def fx_fy_from_fov(W: int, H: int, hfov_deg: float, vfov_deg: float) -> Tuple[float,float]:
-    hf = math.radians(hfov_deg); vf = math.radians(vfov_deg)
-    fx = (W/2.0) / math.tan(hf/2.0)
-    fy = (H/2.0) / math.tan(vf/2.0)
-    return fx, fy
-
 def rot_x(deg: float) -> np.ndarray:
     t = math.radians(deg)
     c, s = math.cos(t), math.sin(t)
     return np.array([[1,0,0],[0,c,-s],[0,s,c]], dtype=np.float32)
 
-def depth_from_height_px(h_px: int, true_h_m: float, fy_px: float) -> float:
-    h = max(1, int(h_px))
-    return (fy_px * true_h_m) / float(h)
-
-def cam_xy_from_pixel(u: float, v: float, Zc: float, fx_px: float, fy_px: float, cx: float, cy: float) -> Tuple[float,float]:
+# Pose / FOV derived constants (pure functions of the config above)
+R_WC       = rot_x(-CAM_PITCH_DEG)      # camera -> world
+R_WC_T     = R_WC.T.copy()              # row-vector form for batched points
+CAM_POS_W  = np.array([0.0, 0.0, CAM_HEIGHT_M], dtype=np.float32)
+TAN_HALF_H = math.tan(math.radians(HFOV_DEG) / 2.0)
+TAN_HALF_V = math.tan(math.radians(VFOV_DEG) / 2.0)
+
+# Known height per class index (NaN = unknown), so a frame's heights are one gather
+OBJ_HEIGHTS_BY_CLS = np.array([OBJ_HEIGHTS.get(c, np.nan) for c in CLASSES], dtype=np.float64)
+
+@lru_cache(maxsize=8)
+def fx_fy_for_size(W: int, H: int) -> Tuple[float,float]:
+    return (W/2.0) / TAN_HALF_H, (H/2.0) / TAN_HALF_V
+
+def estimate_3d_for_bboxes(dets: List[Dict[str, Any]], fx_px: float, fy_px: float,
+                           cx: float, cy: float, R_wc_T: np.ndarray, cam_pos_w: np.ndarray) -> List[Dict[str, float]]:
+    """
+    3D estimates for all detections of a frame in one vectorized pass.
+    Depth comes from the known object height; the bottom-center of the box is back-projected.
+    Returns one dict per detection ({} when the label has no known height).
+    """
+    if not dets:
+        return []
+    bb = np.array([d["bbox"] for d in dets], dtype=np.float64)          # (N, 4)
+    ci = np.array([d["cls_idx"] for d in dets], dtype=np.int64)
+    true_h = OBJ_HEIGHTS_BY_CLS[np.clip(ci, 0, len(CLASSES) - 1)]
+    true_h[(ci < 0) | (ci >= len(CLASSES))] = np.nan                    # no label -> no height
+    h_px = np.maximum(1.0, bb[:, 3] - bb[:, 1])
+    u = (bb[:, 0] + bb[:, 2]) * 0.5     # bottom center works well for upright objects
+    v = bb[:, 3]
+
+    Zc = (fy_px * true_h) / h_px
     Xc = (u - cx) * Zc / fx_px
     Yc = (v - cy) * Zc / fy_px
-    return float(Xc), float(Yc)
-
-def estimate_3d_for_bbox(bbox: Tuple[int,int,int,int], label: str, fx_px: float, fy_px: float,
-                         cx: float, cy: float, R_wc: np.ndarray, cam_pos_w: np.ndarray) -> Dict[str, float]:
-    x1,y1,x2,y2 = bbox
-    h_px = max(1, y2 - y1)
-    u = (x1 + x2) * 0.5     # bottom center works well for upright objects
-    v = float(y2)
-
-    true_h = OBJ_HEIGHTS.get(label, None)
-    if true_h is None:
-        return {}
-
-    Zc = depth_from_height_px(h_px, true_h, fy_px)
-    Xc, Yc = cam_xy_from_pixel(u, v, Zc, fx_px, fy_px, cx, cy)
-    pc = np.array([Xc, Yc, Zc], dtype=np.float32)
-    pw = cam_pos_w + R_wc @ pc
-    return {"Xc": float(Xc), "Yc": float(Yc), "Zc": float(Zc),
-            "Xw": float(pw[0]), "Yw": float(pw[1]), "Zw": float(pw[2])}
+    pc = np.stack([Xc, Yc, Zc], axis=1)                                  # (N, 3) camera, float64 for output
+    pw = pc.astype(np.float32) @ R_wc_T                                  # (N, 3) world, one matmul
+    pw += cam_pos_w
+
+    out = []
+    for known, (xc, yc, zc), (xw, yw, zw) in zip((~np.isnan(true_h)).tolist(), pc.tolist(), pw.tolist()):
+        out.append({"Xc": xc, "Yc": yc, "Zc": zc, "Xw": xw, "Yw": yw, "Zw": zw} if known else {})
+    return out
 
 # -------- Global Identity Manager (radius+time+continuity only) --------
 class IdentityManager:
@@ -152,7 +216,9 @@ class IdentityManager:
         self.classes = classes
         self.next_gid = 0
         self.active: Dict[int, Dict[str, Any]] = {}    # gid -> {cls, bbox, center, last_frame}
-        self.inactive: List[Dict[str, Any]] = []       # [{gid, cls, bbox, center, last_frame}]
+        # [{gid, cls, bbox, center, last_frame}], oldest last_frame first: tracks are appended when
+        # demoted, and a demoted track was last seen on the previous frame, so appends keep the order
+        self.inactive: Deque[Dict[str, Any]] = deque()
 
         self.cls_group: Dict[int, int] = {}
         group_id = 0
@@ -163,66 +229,79 @@ class IdentityManager:
                 for ci in indices:
                     self.cls_group[ci] = group_id
                 group_id += 1
-
-    def _same_continuity_class(self, ci_a: int, ci_b: int) -> bool:
-        if ci_a == ci_b: return True
-        ga = self.cls_group.get(ci_a, None)
-        gb = self.cls_group.get(ci_b, None)
-        return ga is not None and ga == gb
+        # Same map as an array indexed by class (-1 = no group), for the vectorized matcher
+        self.cls_group_arr = np.full(max(1, len(self.classes)), -1, dtype=np.int8)
+        for ci, g in self.cls_group.items():
+            self.cls_group_arr[ci] = g
 
     def _new_gid(self, cls_idx: int, bbox, center, frame_idx: int) -> int:
         gid = self.next_gid; self.next_gid += 1
         self.active[gid] = {"cls": cls_idx, "bbox": bbox, "center": center, "last_frame": frame_idx}
         return gid
 
-    def _match_pool(self, det, pool, frame_idx) -> Optional[int]:
-        ci = det["cls_idx"]; dc = det["center"]
-        best_gid, best_dist, best_pos = None, float("inf"), -1
-        for idx, item in enumerate(pool):
-            age = frame_idx - item["last_frame"]
-            if age < 0 or age > REID_MAX_FRAMES:
+    def _group_arr(self, cls: np.ndarray) -> np.ndarray:
+        """Continuity group per class index (-1 = no group, including out-of-range indices)."""
+        ok = (cls >= 0) & (cls < len(self.cls_group_arr))
+        return np.where(ok, self.cls_group_arr[np.where(ok, cls, 0)], -1)
+
+    def _match_pool(self, det_centers: np.ndarray, det_cls: np.ndarray, det_idx: List[int],
+                    pool: List[Dict[str, Any]], frame_idx: int) -> List[Tuple[int, int]]:
+        """
+        Greedy nearest-center match of detections det_idx against pool, in detection order,
+        from one (D, P) distance matrix. Returns (det index, pool position) pairs; every pool
+        item is used at most once. No side effects: the caller accepts the pairs.
+        """
+        if not det_idx or not pool:
+            return []
+        pc = np.array([it["center"] for it in pool], dtype=np.float64)
+        p_cls = np.array([it["cls"] for it in pool], dtype=np.int64)
+        age = frame_idx - np.array([it["last_frame"] for it in pool], dtype=np.int64)
+        d_cls = det_cls[det_idx]
+
+        dist = np.linalg.norm(det_centers[det_idx][:, None, :] - pc[None, :, :], axis=-1)
+        g_det = self._group_arr(d_cls); g_pool = self._group_arr(p_cls)
+        same = (d_cls[:, None] == p_cls[None, :]) | ((g_det[:, None] >= 0) & (g_det[:, None] == g_pool[None, :]))
+        ok = same & ((age >= 0) & (age <= REID_MAX_FRAMES))[None, :] & (dist <= REID_MAX_RADIUS_PX)
+        dist = np.where(ok, dist, np.inf)
+
+        pairs = []
+        for row, i in enumerate(det_idx):
+            pos = int(np.argmin(dist[row]))
+            if not np.isfinite(dist[row, pos]):
                 continue
-            if not self._same_continuity_class(item["cls"], ci):
-                continue
-            dist = center_dist(dc, item["center"])
-            if dist <= REID_MAX_RADIUS_PX and dist < best_dist:
-                best_gid, best_dist, best_pos = item["gid"], dist, idx
-        if best_gid is None:
-            return None
-        item = pool.pop(best_pos)
-        self.active[best_gid] = {
-            "cls": item["cls"],
-            "bbox": det["bbox"],
-            "center": det["center"],
-            "last_frame": frame_idx
-        }
-        return best_gid
+            dist[:, pos] = np.inf   # consumed by this detection
+            pairs.append((i, pos))
+        return pairs
 
     def assign(self, frame_idx: int, frame: np.ndarray, dets: List[Dict[str, Any]]) -> Dict[int, int]:
-        used_gids = set()
         idx_to_gid: Dict[int, int] = {}
+        det_centers = np.array([d["center"] for d in dets], dtype=np.float64).reshape(-1, 2)
+        det_cls = np.array([d["cls_idx"] for d in dets], dtype=np.int64)
+
+        # Try active first (pool snapshot taken once, records updated only for accepted pairs)
+        active_pool = [{"gid": gid, **rec} for gid, rec in self.active.items()]
+        for i, pos in self._match_pool(det_centers, det_cls, list(range(len(dets))), active_pool, frame_idx):
+            gid = active_pool[pos]["gid"]
+            self.active[gid] = {"cls": active_pool[pos]["cls"], "bbox": dets[i]["bbox"],
+                                "center": dets[i]["center"], "last_frame": frame_idx}
+            idx_to_gid[i] = gid
 
-        # Try active first
-        for i, det in enumerate(dets):
-            gid = self._match_pool(det, pool=[{"gid": gid, **rec} for gid, rec in self.active.items()], frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid)
-                idx_to_gid[i] = gid
-
-        # Then inactive
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: continue
-            gid = self._match_pool(det, pool=self.inactive, frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid)
-                idx_to_gid[i] = gid
+        # Then inactive (matched items move back to active)
+        rest = [i for i in range(len(dets)) if i not in idx_to_gid]
+        taken = set()
+        for i, pos in self._match_pool(det_centers, det_cls, rest, self.inactive, frame_idx):
+            item = self.inactive[pos]
+            self.active[item["gid"]] = {"cls": item["cls"], "bbox": dets[i]["bbox"],
+                                        "center": dets[i]["center"], "last_frame": frame_idx}
+            idx_to_gid[i] = item["gid"]
+            taken.add(pos)
+        if taken:
+            self.inactive = deque(it for k, it in enumerate(self.inactive) if k not in taken)
 
         # New IDs
         for i, det in enumerate(dets):
             if i in idx_to_gid: continue
-            gid = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
-            used_gids.add(gid)
-            idx_to_gid[i] = gid
+            idx_to_gid[i] = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
 
         # Move inactive (not used this frame)
         updated = set(idx_to_gid.values())
@@ -231,18 +310,120 @@ class IdentityManager:
                 rec = self.active.pop(gid)
                 self.inactive.append({"gid": gid, **rec})
 
-        # Drop stale inactives
-        self.inactive = [it for it in self.inactive if (frame_idx - it["last_frame"]) <= REID_MAX_FRAMES]
+        # Drop stale inactives (only the oldest end can be stale)
+        while self.inactive and (frame_idx - self.inactive[0]["last_frame"]) > REID_MAX_FRAMES:
+            self.inactive.popleft()
         return idx_to_gid
 
-# ---------------- Live webcam -> overlay + per-frame JSON ----------------
-def main():
-    # Init model + prompts
+def engine_path_for(weights: str, classes: List[str], imgsz: int) -> Path:
+    """Engine file keyed on weights, prompt classes and input size (the engine bakes all three in)."""
+    key = hashlib.sha1("\n".join(classes).encode()).hexdigest()[:8]
+    return Path(weights).with_name(f"{Path(weights).stem}-{imgsz}-{key}.engine")
+
+def load_model() -> Tuple[YOLOE, bool]:
+    """
+    PyTorch YOLOE with text prompts set, or, on CUDA with USE_TENSORRT, an FP16 TensorRT
+    engine exported from it once and reused on later runs.
+    Returns (model, static_input): a static engine only accepts IMGSZ x IMGSZ input.
+    """
+    if DEVICE is not None and USE_TENSORRT:
+        engine = engine_path_for(WEIGHTS, CLASSES, IMGSZ)
+        try:
+            if not engine.exists():
+                model = YOLOE(WEIGHTS)
+                prepare_prompts(model, CLASSES)   # classes must be set before export
+                exported = model.export(format="engine", half=True, imgsz=IMGSZ, dynamic=False,
+                                        workspace=4, device=DEVICE)
+                Path(exported).rename(engine)
+            return YOLOE(str(engine), task="segment"), True
+        except Exception as e:   # no TensorRT / export failure: fall back to PyTorch
+            print(f"TensorRT engine unavailable ({e}); using PyTorch weights", file=sys.stderr)
+
     model = YOLOE(WEIGHTS)
     if DEVICE is not None:
         model.to(DEVICE)
     prepare_prompts(model, CLASSES)
+    return model, False
+
+# ---------------- Capture thread ----------------
+class FrameGrabber:
+    """
+    Newest-wins handoff between a webcam capture thread and the inference loop.
+    The capture thread keeps reading at camera rate and overwrites the single slot,
+    so inference always starts on the freshest frame; stale frames are simply dropped.
+    """
+    def __init__(self, cap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.frame = None
+        self.fresh = False   # slot holds a frame the consumer hasn't taken yet
+        self.ok = True
+        self.stop_evt = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="webcam-capture", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_evt.is_set():
+            ok, frame = self.cap.read()  # fresh array per read, so handing off the reference is safe
+            with self.cond:
+                if not ok or frame is None:
+                    self.ok = False
+                else:
+                    self.frame, self.fresh = frame, True
+                self.cond.notify()
+            if not self.ok:
+                break
+
+    def read(self, timeout: float = 1.0):
+        """Wait for a frame newer than the last one returned. Returns (ok, frame)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.fresh or not self.ok, timeout)
+            if not self.fresh:
+                return False, None
+            self.fresh = False
+            return True, self.frame
+
+    def stop(self):
+        self.stop_evt.set()
+        self.thread.join(timeout=1.0)
+
+# ---------------- JSON output ----------------
+def stdout_has_reader() -> bool:
+    """False when stdout is a terminal or /dev/null, i.e. nobody consumes the per-frame JSON."""
+    try:
+        if sys.stdout.isatty():
+            return False
+        st, dn = os.fstat(sys.stdout.fileno()), os.stat(os.devnull)
+        return (st.st_dev, st.st_ino) != (dn.st_dev, dn.st_ino)
+    except (OSError, ValueError, AttributeError):   # no real fd (e.g. replaced stdout): assume a reader
+        return True
+
+def dumps_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def json_writer(q: "queue.Queue") -> None:
+    """Serialize + write one JSON array per frame to stdout, off the capture/inference loop."""
+    out = sys.stdout.buffer
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        out.write(dumps_json(item) + b"\n")
+        out.flush()
+
+# ---------------- Live webcam -> overlay + per-frame JSON ----------------
+def main():
+    # Init model + prompts (TensorRT FP16 engine on CUDA when available)
+    model, static_input = load_model()
     use_half = (DEVICE is not None)  # half on CUDA; keep False for CPU
+    if DEVICE is not None:
+        torch.backends.cudnn.benchmark = True            # fixed input size: let cuDNN pick the fastest kernels
+        torch.set_float32_matmul_precision("medium")
 
     # Camera
     cap = cv2.VideoCapture(CAM_INDEX)
@@ -251,72 +432,96 @@ def main():
     # Ask for a decent resolution (best-effort)
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # keep the driver queue shallow; we only want the newest frame
 
-    cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+    if SHOW:
+        cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
 
     # Identity manager & intrinsics (computed on first frame)
     idman = IdentityManager(CLASSES)
     fx = fy = cx = cy = None
-    R_wc = rot_x(-CAM_PITCH_DEG)            # camera -> world
-    cam_pos_w = np.array([0.0, 0.0, CAM_HEIGHT_M], dtype=np.float32)
+    overlay = out = gid_map = None   # per-frame scratch buffers, allocated once on the first frame
+    lb: Optional[GpuLetterbox] = None
 
     last_t = time.time()
     frame_idx = 0
 
+    # Per-frame JSON goes through a bounded queue to a writer thread so a slow stdout reader can't stall us.
+    # Interactive runs (stdout is a TTY or /dev/null) skip the 3D estimates and JSON entirely.
+    json_sink = stdout_has_reader()
+    json_q: "queue.Queue" = queue.Queue(maxsize=JSON_QUEUE_SIZE)
+    writer = threading.Thread(target=json_writer, args=(json_q,), name="json-writer", daemon=True)
+    if json_sink:
+        writer.start()
+
+    # Capture runs on its own thread so cap.read() overlaps with inference
+    grabber = FrameGrabber(cap).start()
+
     try:
         while True:
-            ok, frame = cap.read()
-            if not ok or frame is None:
+            ok, frame = grabber.read()
+            if not ok:
                 break
 
             H, W = frame.shape[:2]
             if fx is None:
-                fx, fy = fx_fy_from_fov(W, H, HFOV_DEG, VFOV_DEG)
+                fx, fy = fx_fy_for_size(W, H)
                 cx, cy = W/2.0, H/2.0
+            if overlay is None or overlay.shape != frame.shape:
+                overlay = np.empty_like(frame); out = np.empty_like(frame)
+                gid_map = np.empty((H, W), dtype=np.int16)
+                if DEVICE is not None and GPU_PREPROCESS:
+                    lb = GpuLetterbox((H, W), IMGSZ, torch.device("cuda", DEVICE), square=static_input)
 
             # Predict on this frame (seg+boxes)
             results = model.predict(
-                source=frame,
+                source=frame if lb is None else lb(frame),
                 imgsz=IMGSZ, conf=CONF, iou=IOU,
                 device=DEVICE, half=use_half, verbose=False
             )
             r = results[0]
 
             # Parse + assign global IDs
-            dets = parse_detections(r, CLASSES, (H, W))
+            dets = parse_detections(r, CLASSES, (H, W), lb)
             idx_to_gid = idman.assign(frame_idx, frame, dets)
 
-            # Paint overlay (masks)
-            overlay = frame.copy()
-            for i, det in enumerate(dets):
-                gid = idx_to_gid[i]
-                col = color_for_gid(gid)
-                m = det.get("mask", None)
-                if m is not None and m.shape == (H, W):
-                    overlay[m] = col
-            out = cv2.addWeighted(overlay, 0.35, frame, 0.65, 0.0)
+            # Paint overlay (masks): write palette indices into one int16 map (later masks win),
+            # then color all covered pixels with a single gather
+            if SHOW:
+                np.copyto(overlay, frame)
+                gid_map.fill(-1)
+                for i, det in enumerate(dets):
+                    m = det.get("mask", None)
+                    if m is not None and m.shape == (H, W):
+                        gid_map[m] = idx_to_gid[i] % len(GID_PALETTE)
+                covered = gid_map >= 0
+                overlay[covered] = GID_PALETTE[gid_map[covered]]
+                cv2.addWeighted(overlay, 0.35, frame, 0.65, 0.0, dst=out)
+
+            # 3D coords (metres) for all detections at once. If class height unknown, coords dict will be empty.
+            coords_list = estimate_3d_for_bboxes(dets, fx, fy, cx, cy, R_WC_T, CAM_POS_W) if json_sink else None
 
             # Draw boxes + labels; build JSON for this frame
             json_list = []
             for i, det in enumerate(dets):
                 gid = idx_to_gid[i]
                 (x1,y1,x2,y2) = det["bbox"]; (cx_px,cy_px) = det["center"]
-                col = color_for_gid(gid)
-
-                # 3D coords (metres). If class height unknown, coords dict will be empty.
-                coords = {}
-                if (fx is not None) and (fy is not None):
-                    coords = estimate_3d_for_bbox(det["bbox"], det["label"], fx, fy, cx, cy, R_wc, cam_pos_w)
 
                 # draw
-                cv2.rectangle(out, (x1,y1), (x2,y2), col, 2)
-                tag = f"{det['label']}  id:{gid}"
-                ytxt = max(12, y1 - 6)
-                cv2.putText(out, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (20,20,20), 2, cv2.LINE_AA)
-                cv2.putText(out, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
-                cv2.circle(out, (int(cx_px), int(cy_px)), 3, (255,255,255), -1)
+                if SHOW:
+                    col = color_for_gid(gid)
+                    cv2.rectangle(out, (x1,y1), (x2,y2), col, 2)
+                    tag = f"{det['label']}  id:{gid}"
+                    ytxt = max(12, y1 - 6)
+                    cv2.putText(out, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (20,20,20), 2, cv2.LINE_AA)
+                    cv2.putText(out, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
+                    cv2.circle(out, (int(cx_px), int(cy_px)), 3, (255,255,255), -1)
+
+                if not json_sink:
+                    continue
 
                 # JSON object
+                coords = coords_list[i]
                 obj = {
                     "frame": int(frame_idx),
                     "global_id": int(gid),
@@ -337,29 +542,39 @@ def main():
             fps = 1.0 / max(1e-6, (now - last_t))
             last_t = now
 
-            # Heads-up panel
-            cv2.rectangle(out, (8,8), (8+740, 8+76), (0,0,0), -1)
-            title = "YOLOE promptable seg + GlobalIDs (radius+time+continuity) + 3D-from-size"
-            cv2.putText(out, title, (14,30), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255,255,255), 1, cv2.LINE_AA)
-            fx_txt = f"fx={fx:.1f}, fy={fy:.1f}, pitch={CAM_PITCH_DEG:.1f}°, h={CAM_HEIGHT_M:.2f}m, FPS={fps:.1f}"
-            cv2.putText(out, fx_txt, (14, 52), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (220,220,220), 1, cv2.LINE_AA)
-
-            # Show window
-            cv2.imshow(WINDOW_NAME, out)
-
-            # Print JSON for this frame to stdout (one array per frame)
-            print(json.dumps(json_list), flush=True)
-
-            # Controls: ESC or q to quit
-            k = cv2.waitKey(1) & 0xFF
-            if k in (27, ord('q')):
+            # Heads-up panel + window
+            if SHOW:
+                cv2.rectangle(out, (8,8), (8+740, 8+76), (0,0,0), -1)
+                title = "YOLOE promptable seg + GlobalIDs (radius+time+continuity) + 3D-from-size"
+                cv2.putText(out, title, (14,30), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255,255,255), 1, cv2.LINE_AA)
+                fx_txt = f"fx={fx:.1f}, fy={fy:.1f}, pitch={CAM_PITCH_DEG:.1f}°, h={CAM_HEIGHT_M:.2f}m, FPS={fps:.1f}"
+                cv2.putText(out, fx_txt, (14, 52), cv2.FONT_HERSHEY_SIMPLEX, 0.48, (220,220,220), 1, cv2.LINE_AA)
+                cv2.imshow(WINDOW_NAME, out)
+
+            # Queue JSON for this frame (one array per frame on stdout); drop it if the reader is behind
+            if json_sink:
+                try:
+                    json_q.put_nowait(json_list)
+                except queue.Full:
+                    pass
+
+            # Controls: ESC or q to quit (Ctrl-C when headless)
+            if SHOW and (cv2.waitKey(1) & 0xFF) in (27, ord('q')):
                 break
 
             frame_idx += 1
 
     finally:
+        if writer.is_alive():
+            try:
+                json_q.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+            writer.join(timeout=1.0)
+        grabber.stop()
         cap.release()
-        cv2.destroyAllWindows()
+        if SHOW:
+            cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     main()
@@ -1,24 +1,156 @@
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from fastapi.responses import JSONResponse, ORJSONResponse
+import httpx
 import json
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import uvicorn
 import os
+import time
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Import your existing AI processing function
-from demo_realtime import get_res_for_id
+# Import your existing AI processing functions
+from demo_realtime import get_res_for_frames
+from fetch_frame import get_frame
+
+AI_MAX_BATCH = int(os.getenv("AI_MAX_BATCH", "8"))
+AI_MAX_WAIT_S = float(os.getenv("AI_MAX_WAIT_MS", "5")) / 1000.0
+
+class InferenceBatcher:
+    """
+    Micro-batches concurrent /ai/process requests: requests park on a future for
+    up to AI_MAX_WAIT_S, then one batched forward pass serves up to AI_MAX_BATCH
+    clients. Duplicate client ids within a batch share one frame and one result.
+    Frame fetches and YOLO block, so both run on `executor`: fetches overlap across
+    workers, inference itself is serialized by demo_realtime's _rt_lock.
+    """
+    def __init__(self, executor: ThreadPoolExecutor, max_batch: int, max_wait: float):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, client_id: str):
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((client_id, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._process(batch)
+
+    async def _process(self, batch):
+        loop = asyncio.get_running_loop()
+        waiters: Dict[str, List[asyncio.Future]] = {}
+        for client_id, fut in batch:
+            waiters.setdefault(client_id, []).append(fut)
+
+        def settle(client_id, result=None, exc=None):
+            for fut in waiters[client_id]:
+                if fut.done():          # request was cancelled meanwhile
+                    continue
+                if exc is not None:
+                    fut.set_exception(exc)
+                else:
+                    fut.set_result(result)
+
+        # Fetch all frames concurrently, then one forward pass for the ones we got
+        client_ids = list(waiters)
+        frames = await asyncio.gather(
+            *(loop.run_in_executor(self.executor, get_frame, cid) for cid in client_ids),
+            return_exceptions=True
+        )
+        ready_ids, ready_frames = [], []
+        for client_id, frame in zip(client_ids, frames):
+            if isinstance(frame, Exception):
+                settle(client_id, exc=frame)
+            elif frame is None:
+                settle(client_id, exc=ValueError(f"No frame available for client {client_id}"))
+            else:
+                ready_ids.append(client_id)
+                ready_frames.append(frame)
+        if not ready_frames:
+            return
+
+        print(f"[DEBUG] Batched AI processing for {len(ready_ids)} clients: {ready_ids}")
+        try:
+            results = await loop.run_in_executor(self.executor, get_res_for_frames, ready_frames)
+        except Exception as e:
+            for client_id in ready_ids:
+                settle(client_id, exc=e)
+            return
+        for client_id, detections in zip(ready_ids, results):
+            settle(client_id, result=detections)
+
+try:
+    import orjson  # optional: faster parse of backend payloads and response encoding
+except ImportError:
+    orjson = None
+
+JSONResponseClass = ORJSONResponse if orjson is not None else JSONResponse
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx when installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """One pooled keep-alive client and one worker pool per app run, both closed on shutdown."""
+    app.state.http = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    )
+    # Created here rather than at import, so a restarted lifespan gets a live pool
+    app.state.executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    app.state.batcher = InferenceBatcher(app.state.executor, AI_MAX_BATCH, AI_MAX_WAIT_S)
+    app.state.batcher.start()
+    try:
+        yield
+    finally:
+        await app.state.batcher.stop()
+        await app.state.http.aclose()
+        app.state.executor.shutdown(wait=False, cancel_futures=True)
 
 # Initialize FastAPI app
 app = FastAPI(
     title="SkySentry AI Processing API",
     description="FastAPI server for processing SkySentry camera feeds with AI models",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=JSONResponseClass
 )
 
 # Add CORS middleware
@@ -36,6 +168,69 @@ FASTAPI_HOST = os.getenv("FASTAPI_HOST", "0.0.0.0")
 FASTAPI_PORT = int(os.getenv("FASTAPI_PORT", "8001"))
 FASTAPI_RELOAD = os.getenv("FASTAPI_RELOAD", "true").lower() == "true"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+FRAME_CACHE_TTL = float(os.getenv("FRAME_CACHE_TTL", "0.5"))     # ~frame cadence
+CLIENTS_CACHE_TTL = float(os.getenv("CLIENTS_CACHE_TTL", "2.0"))
+CACHE_CONTROL = "max-age=1"
+
+class TTLCache:
+    """
+    Small in-process TTL cache for backend JSON with per-key singleflight:
+    concurrent misses on the same key share one upstream request.
+    Failed fetches raise and are not cached.
+    """
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[Any, tuple] = {}   # key -> (expires_at, value)
+        self._locks: Dict[Any, asyncio.Lock] = {}
+
+    def _lookup(self, key):
+        hit = self._data.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            return True, hit[1]
+        return False, None
+
+    def _evict(self):
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in self._data.items() if exp <= now]:
+            del self._data[k]
+        while len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]   # oldest insertion
+        for k in [k for k, l in self._locks.items() if k not in self._data and not l.locked()]:
+            del self._locks[k]
+
+    async def get_or_fetch(self, key, fetch):
+        found, value = self._lookup(key)
+        if found:
+            return value
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            value = await fetch()
+            if len(self._data) >= self.maxsize or len(self._locks) > self.maxsize:
+                self._evict()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            return value
+
+frame_cache = TTLCache(FRAME_CACHE_TTL)
+raw_frame_cache = TTLCache(FRAME_CACHE_TTL)
+meta_cache = TTLCache(FRAME_CACHE_TTL)
+clients_cache = TTLCache(CLIENTS_CACHE_TTL)
+
+async def fetch_backend_bytes(request: Request, url: str) -> bytes:
+    response = await request.app.state.http.get(url)
+    response.raise_for_status()
+    return response.content
+
+async def fetch_backend_json(request: Request, url: str):
+    response = await request.app.state.http.get(url)
+    response.raise_for_status()
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
 
 # Response models
 class ClientInfo(BaseModel):
@@ -75,12 +270,13 @@ async def root():
         "endpoints": {
             "GET /clients": "Get all connected clients",
             "GET /client/{client_id}": "Get latest frame data for specific client",
-            "GET /client/{client_id}/info": "Get frame metadata for specific client"
+            "GET /client/{client_id}/info": "Get frame metadata for specific client",
+            "GET /client/{client_id}/raw": "Backend frame JSON passed through unmodified"
         }
     }
 
 @app.get("/clients", response_model=ClientsListResponse)
-async def get_all_clients(backend_url: str = Query(DEFAULT_BACKEND_URL, description="Backend API URL")):
+async def get_all_clients(request: Request, response: Response, backend_url: str = Query(DEFAULT_BACKEND_URL, description="Backend API URL")):
     """
     Get list of all connected client IDs from the SkySentry backend.
     
@@ -91,11 +287,10 @@ async def get_all_clients(backend_url: str = Query(DEFAULT_BACKEND_URL, descript
         List of client ID strings with success status
     """
     try:
-        response = requests.get(f"{backend_url}/clients", timeout=10)
-        response.raise_for_status()
-        
-        data = response.json() # data is list
-        print(data)
+        data = await clients_cache.get_or_fetch(
+            backend_url, lambda: fetch_backend_json(request, f"{backend_url}/clients")
+        ) # data is list
+        response.headers["Cache-Control"] = CACHE_CONTROL
         clients = data if isinstance(data, list) else []
             
         return ClientsListResponse(
@@ -104,7 +299,7 @@ async def get_all_clients(backend_url: str = Query(DEFAULT_BACKEND_URL, descript
             count=len(clients)
         )
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(
             status_code=503, 
             detail=f"Failed to connect to backend: {str(e)}"
@@ -115,8 +310,39 @@ async def get_all_clients(backend_url: str = Query(DEFAULT_BACKEND_URL, descript
             detail=f"Invalid response from backend: {str(e)}"
         )
 
-@app.get("/client/{client_id}", response_model=FrameResponse)
+# Backend URLs that predate the /latest/meta route (cf. fetch_frame._NO_RAW_ENDPOINT)
+_NO_META_ROUTE: set = set()
+
+async def fetch_frame_meta(request: Request, client_id: str, backend_url: str):
+    """
+    Frame metadata without the base64 image: uses the backend's /latest/meta route so the
+    image is neither transferred nor parsed, falling back to the full /latest payload on 404
+    (older backends without the route, or no frame yet). A backend whose /latest serves a
+    frame after /latest/meta 404'd has no meta route; it is remembered and goes straight to /latest.
+    """
+    key = (client_id, backend_url)
+    meta_missing = False
+    if backend_url not in _NO_META_ROUTE:
+        try:
+            return await meta_cache.get_or_fetch(
+                key, lambda: fetch_backend_json(request, f"{backend_url}/clients/{client_id}/latest/meta")
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            meta_missing = True
+    data = await frame_cache.get_or_fetch(
+        key, lambda: fetch_backend_json(request, f"{backend_url}/clients/{client_id}/latest")
+    )
+    if meta_missing and isinstance(data, dict) and data.get("image"):
+        _NO_META_ROUTE.add(backend_url)
+    return data
+
+# response_model=None: the payload is built here and returned as a ready JSON response, so FastAPI
+# neither validates nor re-encodes the (large) base64 image; FrameResponse still documents it
+@app.get("/client/{client_id}", response_model=None, responses={200: {"model": FrameResponse}})
 async def get_client_frame(
+    request: Request,
     client_id: str, 
     backend_url: str = Query(DEFAULT_BACKEND_URL, description="Backend API URL")
 ):
@@ -131,29 +357,32 @@ async def get_client_frame(
         Complete frame data including base64 image, timestamp, size, and stats
     """
     try:
-        response = requests.get(f"{backend_url}/clients/{client_id}/latest", timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
+        # /client/{id} and /client/{id}/info share the same upstream payload
+        data = await frame_cache.get_or_fetch(
+            (client_id, backend_url),
+            lambda: fetch_backend_json(request, f"{backend_url}/clients/{client_id}/latest"),
+        )
+        headers = {"Cache-Control": CACHE_CONTROL}
         
         # Check if we have image data (the backend doesn't send a 'success' field)
         if not data.get("image"):
-            return FrameResponse(
-                success=False,
-                client_id=client_id,
-                error="No frame available"
+            return JSONResponseClass(
+                FrameResponse(success=False, client_id=client_id, error="No frame available").model_dump(),
+                headers=headers
             )
             
-        return FrameResponse(
-            success=True,
-            client_id=data.get("clientId", client_id),
-            image=data.get("image"),  # Already base64 encoded with data URL prefix
-            timestamp=data.get("timestamp"),
-            size=data.get("size"),
-            stats=data.get("stats", {})
-        )
+        # Trusted backend data: same fields as FrameResponse, without validating the image string
+        return JSONResponseClass({
+            "success": True,
+            "client_id": data.get("clientId", client_id),
+            "image": data.get("image"),  # Already base64 encoded with data URL prefix
+            "timestamp": data.get("timestamp"),
+            "size": data.get("size"),
+            "stats": data.get("stats", {}),
+            "error": None
+        }, headers=headers)
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(
             status_code=503, 
             detail=f"Failed to connect to backend for client {client_id}: {str(e)}"
@@ -164,8 +393,38 @@ async def get_client_frame(
             detail=f"Invalid response from backend for client {client_id}: {str(e)}"
         )
 
+@app.get("/client/{client_id}/raw")
+async def get_client_frame_raw(
+    request: Request,
+    client_id: str,
+    backend_url: str = Query(DEFAULT_BACKEND_URL, description="Backend API URL")
+):
+    """
+    Pass the backend's latest-frame JSON through byte-for-byte.
+    
+    Skips parsing and re-encoding the base64 image; use this when the caller
+    only needs the frame and can read the backend's own field names.
+    """
+    try:
+        content = await raw_frame_cache.get_or_fetch(
+            (client_id, backend_url),
+            lambda: fetch_backend_bytes(request, f"{backend_url}/clients/{client_id}/latest"),
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=503, 
+            detail=f"Failed to connect to backend for client {client_id}: {str(e)}"
+        )
+    return Response(
+        content=content,
+        media_type="application/json",
+        headers={"x-client-id": client_id, "Cache-Control": CACHE_CONTROL}
+    )
+
 @app.get("/client/{client_id}/info", response_model=ClientInfo)
 async def get_client_info(
+    request: Request,
+    response: Response,
     client_id: str, 
     backend_url: str = Query(DEFAULT_BACKEND_URL, description="Backend API URL")
 ):
@@ -180,10 +439,8 @@ async def get_client_info(
         Frame metadata including timestamp, size, and buffer stats
     """
     try:
-        response = requests.get(f"{backend_url}/clients/{client_id}/latest", timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = await fetch_frame_meta(request, client_id, backend_url)
+        response.headers["Cache-Control"] = CACHE_CONTROL
         
         # Check if we have any data (the backend doesn't send a 'success' field)
         if not data.get("clientId") and not data.get("timestamp"):
@@ -199,7 +456,7 @@ async def get_client_info(
             stats=data.get("stats", {})
         )
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(
             status_code=503, 
             detail=f"Failed to connect to backend for client {client_id}: {str(e)}"
@@ -211,13 +468,13 @@ async def get_client_info(
         )
 
 @app.get("/ai/process/{client_id}", response_model=AIProcessingResponse)
-async def process_client_with_ai(client_id: str):
+async def process_client_with_ai(request: Request, client_id: str):
     """
     Process the latest frame from a client ID with AI object detection using YOLO.
     
     This endpoint:
     1. Fetches the latest frame from the specified client ID
-    2. Runs YOLO object detection and tracking 
+    2. Runs YOLO object detection and tracking (batched with concurrent requests)
     3. Returns detected objects with bounding boxes, labels, and tracking IDs
     
     Args:
@@ -229,10 +486,9 @@ async def process_client_with_ai(client_id: str):
     print(f"[DEBUG] AI processing request for client: {client_id}")
     
     try:
-        # Call your existing AI processing function
-        print(f"[DEBUG] Calling get_res_for_id for client: {client_id}")
-        detections = get_res_for_id(client_id)
-        print(f"[DEBUG] get_res_for_id returned for client {client_id}: {detections}")
+        # Park on the batcher; it fetches the frame and runs one forward pass per batch
+        detections = await request.app.state.batcher.submit(client_id)
+        print(f"[DEBUG] Batcher returned for client {client_id}: {detections}")
         
         if detections is None:
             print(f"[WARN] Detections is None for client {client_id}")
@@ -9,6 +9,10 @@ device = infer_device()
 
 processor = AutoProcessor.from_pretrained(model_id)
 model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(device)
+on_gpu = model.device.type == "cuda"
+if on_gpu:
+    # Fuse kernels and capture CUDA graphs; input shapes are fixed here, so no dynamic shapes
+    model = torch.compile(model, mode="reduce-overhead", dynamic=False)
 
 
 image_path = Path("test_images/IMG_7679.jpg")  
@@ -17,24 +21,34 @@ image = Image.open(image_path).convert("RGB")
 
 # Check for cats and remote controls
 text_labels = [["a person", "a hat"]]
+
+# Warm-up: the first call of a compiled model traces/compiles, keep it out of the timing
+if on_gpu:
+    warm = processor(images=image, text=text_labels, return_tensors="pt").to(model.device)
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16):
+        model(**warm)
+    torch.cuda.synchronize()
+
 t1 = time.time()
 
 inputs = processor(images=image, text=text_labels, return_tensors="pt").to(model.device)
 
 
-with torch.no_grad():
+# FP16 autocast on GPU; inference_mode also skips autograd's view/version tracking
+with torch.inference_mode(), torch.autocast(device_type=model.device.type, dtype=torch.float16, enabled=on_gpu):
     outputs = model(**inputs)
 
 print('process: ', time.time() - t1)
 
 t2 = time.time()
-results = processor.post_process_grounded_object_detection(
-    outputs,
-    inputs.input_ids,
-    threshold=0.4,
-    text_threshold=0.3,
-    target_sizes=[image.size[::-1]]  # (H, W)
-)
+with torch.inference_mode():
+    results = processor.post_process_grounded_object_detection(
+        outputs,
+        inputs.input_ids,
+        threshold=0.4,
+        text_threshold=0.3,
+        target_sizes=[image.size[::-1]]  # (H, W)
+    )
 
 
 print('PostProcess: ', time.time() - t2)
@@ -1,9 +1,13 @@
 import cv2
 import math
+import queue
+import threading
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from collections import defaultdict, deque
+from collections import defaultdict, namedtuple
+
+from vis_utils import color_for_gid, draw_label, open_video_writer
 
 """
 Visualize tracked objects from CSV side-by-side with video:
@@ -31,6 +35,8 @@ TRAIL_LEN       = 60       # number of points kept per trail (world coords)
 MEAN_WIN        = 10       # rolling average window for the smoothed line
 ACTIVE_ONLY     = True     # draw trails only for objects detected in the current frame
 STALE_TTL       = 30       # frames; prune trails if object absent for > this many frames
+SKIP_EVERY      = 1        # render every Nth frame (1 = all); skipped frames are grabbed, never retrieved
+DETECTIONS_ONLY = False    # render only frames that have CSV rows; others are grabbed, never retrieved
 
 # Drawing
 FONT            = cv2.FONT_HERSHEY_SIMPLEX
@@ -51,40 +57,79 @@ TRAIL_GREY      = (160, 160, 160)  # greyed-out trail color
 MAP_PAD         = 0.5
 
 DISPLAY_SCALE   = 0.6
+WRITE_QUEUE     = 8        # composited frames buffered for the encoder thread
+HW_ENCODE       = True     # try NVENC through GStreamer first, fall back to software mp4v
 # -----------------------------------------------------------------------------
 
-def color_for_id(gid: int):
-    return (
-        60 + (37 * (gid + 1)) % 195,
-        60 + (91 * (gid + 1)) % 195,
-        60 + (13 * (gid + 1)) % 195,
-    )
+def _write_frames(writer, q: "queue.Queue"):
+    """Encoder thread: write frames in order until the None sentinel."""
+    while True:
+        frame = q.get()
+        if frame is None:
+            break
+        writer.write(frame)
+
+# Current-object dots: the AA disc is rasterized once as a coverage sprite and alpha-blended
+# into place, instead of a cv2.circle rasterization per object per frame
+def _make_dot_sprite(r: int) -> np.ndarray:
+    """(2r+3, 2r+3, 1) float32 coverage in [0,1]; the extra pixel each side holds the AA fringe."""
+    m = np.zeros((2*r + 3, 2*r + 3), np.uint8)
+    cv2.circle(m, (r + 1, r + 1), r, 255, -1, cv2.LINE_AA)
+    return (m.astype(np.float32) / 255.0)[..., None]
+
+_DOT_ALPHA = _make_dot_sprite(POINT_RADIUS)
+
+def draw_dot(img, u: int, v: int, col):
+    """Same look as cv2.circle(img, (u,v), POINT_RADIUS, col, -1, LINE_AA), clipped to img."""
+    R = POINT_RADIUS + 1
+    H, W = img.shape[:2]
+    x0, y0 = max(u - R, 0), max(v - R, 0)
+    x1, y1 = min(u + R + 1, W), min(v + R + 1, H)
+    if x0 >= x1 or y0 >= y1:
+        return
+    a = _DOT_ALPHA[y0 - (v - R):y1 - (v - R), x0 - (u - R):x1 - (u - R)]
+    roi = img[y0:y1, x0:x1]
+    roi[:] = roi * (1.0 - a) + np.asarray(col, np.float32) * a + 0.5
 
 # ---------------- Data loading ----------------
 
+NUMERIC_COLS = ["frame","global_id","Xw","Yw","Zw"]
+
 def load_tracks(csv_path: str):
-    df = pd.read_csv(csv_path)
-    # Ensure columns exist
+    # Ensure columns exist (header only)
     needed = {"frame","global_id","label","Xw","Yw","Zw","cx","cy","x1","y1","x2","y2"}
-    missing = needed - set(df.columns)
+    missing = needed - set(pd.read_csv(csv_path, nrows=0).columns)
     if missing:
         raise SystemExit(f"CSV missing columns: {missing}")
 
-    # Coerce numeric
-    for c in ["frame","global_id","Xw","Yw","Zw"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-    df = df.dropna(subset=["frame","global_id","Xw","Yw","Zw"])  # keep only rows with world coords
+    # Parse only the columns we use, numeric ones straight to float64 (empty cells -> NaN)
+    usecols = NUMERIC_COLS + ["label"]
+    try:
+        df = pd.read_csv(csv_path, usecols=usecols, dtype={c: np.float64 for c in NUMERIC_COLS})
+    except ValueError:
+        # non-numeric junk in a numeric column: lenient parse, then coerce it to NaN
+        df = pd.read_csv(csv_path, usecols=usecols)
+        for c in NUMERIC_COLS:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    df = df.dropna(subset=NUMERIC_COLS)  # keep only rows with world coords
+
+    # Build per-frame list of detections from whole columns (no per-row Series):
+    # stable-sort by frame, then slice each frame's contiguous segment
+    frame_col = df["frame"].to_numpy(np.int64)
+    gids = df["global_id"].to_numpy(np.int64).tolist()
+    xyz = df[["Xw","Yw","Zw"]].to_numpy(np.float64).tolist()
+    labels = [str(x) for x in df["label"].tolist()]
+    order = np.argsort(frame_col, kind="stable")
+    uniq, starts = np.unique(frame_col[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    order = order.tolist()
 
-    # Build per-frame list of detections
     frames = defaultdict(list)
-    for _, r in df.iterrows():
-        frames[int(r.frame)].append({
-            "gid": int(r.global_id),
-            "label": str(r.label),
-            "Xw": float(r.Xw),
-            "Yw": float(r.Yw),
-            "Zw": float(r.Zw),
-        })
+    for f, a, b in zip(uniq.tolist(), starts.tolist(), ends.tolist()):
+        frames[f] = [
+            {"gid": gids[i], "label": labels[i], "Xw": xyz[i][0], "Yw": xyz[i][1], "Zw": xyz[i][2]}
+            for i in order[a:b]
+        ]
 
     # World extents for scaling
     if len(df) == 0:
@@ -100,92 +145,135 @@ def load_tracks(csv_path: str):
 
 # ---------------- Helpers ----------------
 
+class TrailBuf:
+    """
+    Fixed-size ring of (Xw, Yw, Zw) float64 rows for one gid; the oldest row is overwritten when full.
+    Rendering reads one contiguous array instead of converting a deque of tuples every frame.
+    """
+    __slots__ = ("buf", "head", "count")
+
+    def __init__(self, cap: int = TRAIL_LEN):
+        self.buf = np.empty((cap, 3), np.float64)
+        self.head = 0   # next write slot
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, x: float, y: float, z: float):
+        self.buf[self.head] = (x, y, z)
+        self.head = (self.head + 1) % len(self.buf)
+        self.count = min(self.count + 1, len(self.buf))
+
+    def view(self) -> np.ndarray:
+        """Valid rows in chronological order (newest last)."""
+        if self.count < len(self.buf):
+            return self.buf[:self.count]
+        return np.concatenate((self.buf[self.head:], self.buf[:self.head]))
+
 def rolling_mean(points, win):
     """Compute rolling-average polyline.
-    points: list of tuples (x,y[,z]) in world coords.
-    Returns a list of same-dimension tuples of smoothed points.
+    points: (N, D) array or list of tuples (x,y[,z]) in world coords.
+    Returns an (N, D) float64 array of smoothed points.
     """
-    if not points:
-        return []
-
-    pts = np.array(points, dtype=np.float32)  # shape (N, D)
+    pts = np.asarray(points, dtype=np.float64)  # shape (N, D)
+    if len(pts) == 0:
+        return np.empty((0, pts.shape[1] if pts.ndim == 2 else 0))
     N, D = pts.shape
-    out = []
-    for i in range(N):
-        k = min(win, i + 1)
-        seg = pts[i - k + 1:i + 1]
-        m = seg.mean(axis=0)
-        out.append(tuple(m.tolist()))
-    return out
+    # window sums from one cumulative sum: sum(pts[i-k+1:i+1]) = c[i+1] - c[i+1-k]
+    c = np.zeros((N + 1, D), dtype=np.float64)
+    np.cumsum(pts, axis=0, out=c[1:])
+    idx = np.arange(1, N + 1)
+    k = np.minimum(idx, win)
+    return (c[idx] - c[idx - k]) / k[:, None]
 
 # ---------------- Rendering ----------------
 
-def render_topdown_panel(panel_size, objects, trails, bounds, active_gids):
-    """Draw top-down X-Y map with grey trails and colored mean lines + labels (Z ignored).
-    - If ACTIVE_ONLY is True, only draw trails for active_gids (present in this frame).
-    - Otherwise, draw trails for any gid present in trails dict.
-    """
+def make_topdown_background(panel_size):
+    """Static part of the top-down panel (fill, grid, title), rendered once and copied per frame."""
     H = W = panel_size
     img = np.full((H, W, 3), BG_COLOR, np.uint8)
-
-    # Extents with padding
-    xmin, xmax = bounds["xmin"], bounds["xmax"]
-    ymin, ymax = bounds["ymin"], bounds["ymax"]
-    xmin -= MAP_PAD; xmax += MAP_PAD
-    ymin -= MAP_PAD; ymax += MAP_PAD
-
-    def world_to_px(x, y):
-        # Map X → horizontal, Y → vertical (flip Y for screen)
-        u = int((x - xmin) / max(1e-6, (xmax - xmin)) * (W - 1))
-        v = int((1.0 - (y - ymin) / max(1e-6, (ymax - ymin))) * (H - 1))
-        return u, v
-
-    # grid
     for t in np.linspace(0.0, 1.0, 5):
         xg = int(t*(W-1))
         yg = int(t*(H-1))
         cv2.line(img, (xg, 0), (xg, H-1), GRID_COLOR, 1)
         cv2.line(img, (0, yg), (W-1, yg), GRID_COLOR, 1)
+    cv2.putText(img, "Top-down (X-Y)", (8, 22), FONT, 0.6, (220,220,220), 1, cv2.LINE_AA)
+    return img
+
+# World → panel mapping constants; fixed for the whole video, so computed once
+TopdownView = namedtuple("TopdownView", "xmin ymin span_x span_y px_w px_h")
+
+def make_topdown_view(panel_size, bounds) -> TopdownView:
+    # Extents with padding
+    xmin, xmax = bounds["xmin"] - MAP_PAD, bounds["xmax"] + MAP_PAD
+    ymin, ymax = bounds["ymin"] - MAP_PAD, bounds["ymax"] + MAP_PAD
+    return TopdownView(xmin, ymin, max(1e-6, (xmax - xmin)), max(1e-6, (ymax - ymin)),
+                       panel_size - 1, panel_size - 1)
+
+def world_to_px(view: TopdownView, xy):
+    """Map X → horizontal, Y → vertical (flip Y for screen), for an (N,2+) array of points.
+    astype truncates toward zero like a scalar int().
+    """
+    uv = np.empty((len(xy), 2), np.int32)
+    uv[:, 0] = (xy[:, 0] - view.xmin) / view.span_x * view.px_w
+    uv[:, 1] = (1.0 - (xy[:, 1] - view.ymin) / view.span_y) * view.px_h
+    return uv
+
+def render_topdown_panel(panel_size, objects, trails, bounds, active_gids, bg=None, out=None, view=None):
+    """Draw top-down X-Y map with grey trails and colored mean lines + labels (Z ignored).
+    - If ACTIVE_ONLY is True, only draw trails for active_gids (present in this frame).
+    - Otherwise, draw trails for any gid present in trails dict.
+    - bg: prebuilt make_topdown_background(panel_size); built here if not given.
+    - out: (panel_size, panel_size, 3) uint8 buffer to draw into and return; allocated if not given.
+    - view: prebuilt make_topdown_view(panel_size, bounds); built here if not given.
+    """
+    if bg is None:
+        bg = make_topdown_background(panel_size)
+    if out is None:
+        out = np.empty_like(bg)
+    if view is None:
+        view = make_topdown_view(panel_size, bounds)
+    np.copyto(out, bg)
+    img = out
 
     # Which gids to draw
     gids_to_draw = set(active_gids) if ACTIVE_ONLY else set(trails.keys())
 
-    # trails (raw) — greyed out
+    # Gather every raw trail and its mean line, then map all points to pixels in one call
+    lines = []   # (color, thickness) per polyline, in draw order
+    pts = []
     for gid in sorted(gids_to_draw):
         q = trails.get(gid)
         if not q or len(q) < 2:
             continue
-        for i in range(1, len(q)):
-            u1,v1 = world_to_px(q[i-1][0], q[i-1][1])
-            u2,v2 = world_to_px(q[i][0],   q[i][1])
-            cv2.line(img, (u1,v1), (u2,v2), TRAIL_GREY, TRAIL_THICK, cv2.LINE_AA)
-
-        # mean / smoothed line — in object color
-        mean_xy = [(p[0], p[1]) for p in rolling_mean(list(q), MEAN_WIN)]
-        if len(mean_xy) >= 2:
-            col = color_for_id(gid)
-            for i in range(1, len(mean_xy)):
-                u1,v1 = world_to_px(mean_xy[i-1][0], mean_xy[i-1][1])
-                u2,v2 = world_to_px(mean_xy[i][0],   mean_xy[i][1])
-                cv2.line(img, (u1,v1), (u2,v2), col, MEAN_THICK, cv2.LINE_AA)
+        trail_xy = q.view()[:, :2]   # Z is unused top-down, so smooth only X-Y
+        pts.append(trail_xy)
+        lines.append((TRAIL_GREY, TRAIL_THICK))          # raw — greyed out
+        pts.append(rolling_mean(trail_xy, MEAN_WIN))
+        lines.append((color_for_gid(gid), MEAN_THICK))    # mean / smoothed — in object color
+    if pts:
+        uv_all = world_to_px(view, np.concatenate(pts))
+        uvs = np.split(uv_all, np.cumsum([len(p) for p in pts])[:-1])
+        # one polylines call per trail instead of one cv2.line per segment
+        for uv, (col, thick) in zip(uvs, lines):
+            cv2.polylines(img, [uv.reshape(-1, 1, 2)], False, col, thick, cv2.LINE_AA)
 
     # points + labels (colored) — only for current objects
-    for o in objects:
-        u,v = world_to_px(o["Xw"], o["Yw"])
-        col = color_for_id(o["gid"])
-        cv2.circle(img, (u,v), POINT_RADIUS, col, -1, cv2.LINE_AA)
+    obj_xy = np.array([(o["Xw"], o["Yw"]) for o in objects], dtype=np.float64).reshape(-1, 2)
+    for o, (u, v) in zip(objects, world_to_px(view, obj_xy).tolist()):
+        col = color_for_gid(o["gid"])
+        draw_dot(img, u, v, col)
         label = f'{o["label"]} id:{o["gid"]}'
-        cv2.putText(img, label, (u+8, v-6), FONT, 0.5, LABEL_SHADOW, 2, cv2.LINE_AA)
-        cv2.putText(img, label, (u+8, v-6), FONT, 0.5, LABEL_FG, 1, cv2.LINE_AA)
+        draw_label(img, label, (u+8, v-6), 0.5, LABEL_FG, LABEL_SHADOW, FONT)
 
-    cv2.putText(img, "Top-down (X-Y)", (8, 22), FONT, 0.6, (220,220,220), 1, cv2.LINE_AA)
     return img
 
 # ---------------- Trail maintenance ----------------
 
 def prune_stale_trails(trails, last_seen, current_frame, ttl):
     """Remove any gid whose last_seen is older than ttl frames ago.
-    Modifies trails and last_seen in place.
+    Modifies trails and last_seen in place. Returns the number of gids removed.
     """
     to_delete = []
     for gid, f in last_seen.items():
@@ -194,6 +282,7 @@ def prune_stale_trails(trails, last_seen, current_frame, ttl):
     for gid in to_delete:
         trails.pop(gid, None)
         last_seen.pop(gid, None)
+    return len(to_delete)
 
 # ---------------- Main ----------------
 
@@ -213,21 +302,38 @@ def main():
     PANEL = H  # make map panel square, same height as video
     out_w = W + PANEL
     out_h = H
-
-    # Trails (world coords): gid -> deque[(Xw,Yw,Zw)]
-    trails = defaultdict(lambda: deque(maxlen=TRAIL_LEN))
+    bg_2d = make_topdown_background(PANEL)
+    view_2d = make_topdown_view(PANEL, bounds)
+
+    # Buffers reused across frames. Canvases rotate through a pool one larger than the encoder's
+    # reach (queue + the frame being written), so a canvas is never redrawn while still queued.
+    canvases = [np.empty((out_h, out_w, 3), np.uint8) for _ in range(WRITE_QUEUE + 2)]
+    if DISPLAY_SCALE == 0.5:
+        disp_size = ((out_w + 1) // 2, (out_h + 1) // 2)   # cv2.pyrDown's output size
+    else:
+        disp_size = (int(round(out_w * DISPLAY_SCALE)), int(round(out_h * DISPLAY_SCALE)))
+    disp = np.empty((disp_size[1], disp_size[0], 3), np.uint8)
+
+    # Trails (world coords): gid -> TrailBuf of (Xw,Yw,Zw)
+    trails = defaultdict(TrailBuf)
     last_seen_frame = {}  # gid -> last frame index when observed
 
     writer = None
     if WRITE_VIDEO:
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
         Path(OUT_PATH).parent.mkdir(parents=True, exist_ok=True)
-        writer = cv2.VideoWriter(str(OUT_PATH), fourcc, FPS, (out_w, out_h))
+        writer = open_video_writer(OUT_PATH, FPS / SKIP_EVERY, (out_w, out_h), hw=HW_ENCODE)
+        # Encoding runs on its own thread so it overlaps with rendering the next frame
+        write_q: "queue.Queue" = queue.Queue(maxsize=WRITE_QUEUE)
+        encoder = threading.Thread(target=_write_frames, args=(writer, write_q), name="encoder", daemon=True)
+        encoder.start()
 
     frame_idx = -1
+    n_rendered = 0
+    panel_dirty = True   # objects/trails changed since the panel was last rendered
+    prev_panel = None    # panel region of the previous canvas (still intact: the pool hasn't wrapped)
     while True:
-        ok, frame = cap.read()
-        if not ok:
+        # grab() only advances the stream; retrieve() (BGR conversion) runs for rendered frames only
+        if not cap.grab():
             break
         frame_idx += 1
 
@@ -237,19 +343,37 @@ def main():
 
         # update trails and last_seen
         for o in objs:
-            trails[o["gid"]].append((o["Xw"], o["Yw"], o["Zw"]))
+            trails[o["gid"]].append(o["Xw"], o["Yw"], o["Zw"])
             last_seen_frame[o["gid"]] = frame_idx
 
         # prune old trails (objects absent for > STALE_TTL frames)
-        prune_stale_trails(trails, last_seen_frame, frame_idx, STALE_TTL)
+        if prune_stale_trails(trails, last_seen_frame, frame_idx, STALE_TTL) or objs:
+            panel_dirty = True
 
-        # render top-down panel
-        panel2d = render_topdown_panel(PANEL, objs, trails, bounds, active_gids)
+        # trails stay current on every frame; only rendering is skipped
+        if frame_idx % SKIP_EVERY != 0 or (DETECTIONS_ONLY and not objs):
+            continue
 
-        # compose
-        canvas = np.zeros((out_h, out_w, 3), dtype=np.uint8)
-        canvas[:, :W] = frame
-        canvas[:, W:W+PANEL] = panel2d
+        # decode straight into the video region of this frame's canvas (no frame-sized copy)
+        canvas = canvases[n_rendered % len(canvases)]
+        ok, frame = cap.retrieve(image=canvas[:, :W])
+        if not ok:
+            break
+        n_rendered += 1
+        if not np.may_share_memory(frame, canvas):   # backend handed back its own buffer
+            canvas[:, :W] = frame
+
+        # render the top-down panel straight into its canvas region; quiet stretches
+        # (no objects, nothing pruned) copy the previous canvas's panel instead
+        # (frame + panel cover every pixel, so the canvas is never cleared)
+        panel = canvas[:, W:W+PANEL]
+        if panel_dirty or prev_panel is None:
+            render_topdown_panel(PANEL, objs, trails, bounds, active_gids, bg_2d, out=panel, view=view_2d)
+            # objects drawn now must be cleared by a redraw on the next rendered frame
+            panel_dirty = bool(objs)
+        else:
+            np.copyto(panel, prev_panel)
+        prev_panel = panel
 
         # header strip
         cv2.rectangle(canvas, (0,0), (out_w, 34), HEADER_BG, -1)
@@ -258,22 +382,24 @@ def main():
         if SHOW_WINDOW:
             # shrink only the on-screen preview
             if DISPLAY_SCALE != 1.0:
-                disp = cv2.resize(
-                    canvas, None,
-                    fx=DISPLAY_SCALE, fy=DISPLAY_SCALE,
-                    interpolation=cv2.INTER_AREA
-                )
+                # preview only: bilinear (or one pyrDown at exactly 0.5x) is plenty and much cheaper than INTER_AREA
+                if DISPLAY_SCALE == 0.5:
+                    cv2.pyrDown(canvas, dst=disp)
+                else:
+                    cv2.resize(canvas, disp_size, dst=disp, interpolation=cv2.INTER_LINEAR)
+                cv2.imshow("Video | Top-down", disp)
             else:
-                disp = canvas
-            cv2.imshow("Video | Top-down", disp)
+                cv2.imshow("Video | Top-down", canvas)
             if cv2.waitKey(1) & 0xFF == 27:
                 break
 
         if writer is not None:
-            writer.write(canvas)
+            write_q.put(canvas)   # pooled buffer; not reused until the encoder is done with it
 
     cap.release()
     if writer is not None:
+        write_q.put(None)         # drain pending frames before closing the file
+        encoder.join()
         writer.release()
     cv2.destroyAllWindows()
     print("Done.", "Saved:", OUT_PATH if WRITE_VIDEO else "(no file)")
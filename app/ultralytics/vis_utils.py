@@ -0,0 +1,85 @@
+# vis_utils.py
+# Drawing helpers shared by the realtime modules and the offline scripts (cv2 + numpy only).
+from collections import OrderedDict
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+# ---------------- Global-ID colors ----------------
+def _make_gid_palette() -> np.ndarray:
+    # The per-gid color formula is periodic in gid with period 195, so 195 rows cover every gid exactly.
+    g = np.arange(195)
+    pal = np.empty((195, 3), dtype=np.uint8)
+    pal[:, 0] = 60 + (37 * (g + 1)) % 195
+    pal[:, 1] = 60 + (91 * (g + 1)) % 195
+    pal[:, 2] = 60 + (13 * (g + 1)) % 195
+    return pal
+
+GID_PALETTE = _make_gid_palette()   # (195, 3) uint8 BGR; index with gid % len(GID_PALETTE)
+_GID_COLORS = [tuple(int(c) for c in row) for row in GID_PALETTE]
+
+def color_for_gid(gid: int) -> Tuple[int, int, int]:
+    return _GID_COLORS[gid % len(_GID_COLORS)]
+
+# ---------------- Labels ----------------
+# Shadowed labels (thick dark pass under a thin light pass) are pre-blended once per
+# distinct string/style into (keep, add) float planes, then blitted as roi*keep + add.
+_LABEL_CACHE: "OrderedDict[Tuple, Tuple[np.ndarray, np.ndarray, int, int]]" = OrderedDict()
+_LABEL_CACHE_MAX = 512
+_LABEL_PAD = 3
+
+def _label_patch(text: str, font: int, scale: float, fg: Tuple[int, int, int], shadow: Tuple[int, int, int]):
+    key = (text, font, scale, fg, shadow)
+    hit = _LABEL_CACHE.get(key)
+    if hit is not None:
+        _LABEL_CACHE.move_to_end(key)
+        return hit
+    (tw, th), base = cv2.getTextSize(text, font, scale, 2)
+    h, w = th + base + 2 * _LABEL_PAD, tw + 2 * _LABEL_PAD
+    org = (_LABEL_PAD, _LABEL_PAD + th)
+    a_s = np.zeros((h, w), np.uint8); cv2.putText(a_s, text, org, font, scale, 255, 2, cv2.LINE_AA)
+    a_f = np.zeros((h, w), np.uint8); cv2.putText(a_f, text, org, font, scale, 255, 1, cv2.LINE_AA)
+    a_s = a_s[..., None].astype(np.float32) / 255.0
+    a_f = a_f[..., None].astype(np.float32) / 255.0
+    keep = (1.0 - a_s) * (1.0 - a_f)
+    add = np.array(shadow, np.float32) * a_s * (1.0 - a_f) + np.array(fg, np.float32) * a_f
+    hit = (keep, add, org[0], org[1])
+    _LABEL_CACHE[key] = hit
+    if len(_LABEL_CACHE) > _LABEL_CACHE_MAX:
+        _LABEL_CACHE.popitem(last=False)
+    return hit
+
+def draw_label(img: np.ndarray, text: str, org: Tuple[int, int], scale: float = 0.5,
+               fg: Tuple[int, int, int] = (255, 255, 255), shadow: Tuple[int, int, int] = (10, 10, 10),
+               font: int = cv2.FONT_HERSHEY_SIMPLEX) -> None:
+    """Same look as putText(shadow, thickness 2) + putText(fg, thickness 1) at org, from an LRU patch cache."""
+    keep, add, ox, oy = _label_patch(text, font, scale, fg, shadow)
+    h, w = keep.shape[:2]
+    x0, y0 = int(org[0]) - ox, int(org[1]) - oy
+    xa, ya = max(x0, 0), max(y0, 0)
+    xb, yb = min(x0 + w, img.shape[1]), min(y0 + h, img.shape[0])
+    if xa >= xb or ya >= yb:
+        return
+    roi = img[ya:yb, xa:xb]
+    k = keep[ya-y0:yb-y0, xa-x0:xb-x0]; a = add[ya-y0:yb-y0, xa-x0:xb-x0]
+    roi[:] = (roi * k + a + 0.5).astype(np.uint8)
+
+# ---------------- Video output ----------------
+GST_NVENC_PIPELINE = (
+    "appsrc ! videoconvert ! video/x-raw,format=I420 ! nvh264enc ! h264parse ! "
+    'mp4mux ! filesink location="{path}"'
+)
+
+def _gst_quote(path) -> str:
+    """Escape a path for a double-quoted gst-launch property value (spaces and '!' are fine inside)."""
+    return str(path).replace("\\", "\\\\").replace('"', '\\"')
+
+def open_video_writer(path, fps: float, size, hw: bool = True) -> cv2.VideoWriter:
+    """Hardware H.264 writer when hw and GStreamer + NVENC are available, else software mp4v."""
+    if hw:
+        writer = cv2.VideoWriter(GST_NVENC_PIPELINE.format(path=_gst_quote(path)), cv2.CAP_GSTREAMER, 0, fps, size)
+        if writer.isOpened():
+            return writer
+        writer.release()
+    return cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
@@ -2,12 +2,17 @@
 # pip install --upgrade ultralytics opencv-python
 import math
 import json
+import threading
 from typing import List, Dict, Tuple, Any, Optional
 
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 from ultralytics import YOLOE
 
+from vis_utils import GID_PALETTE, color_for_gid, draw_label
+
 # ---------------- Defaults / Config Structs ----------------
 DEFAULT_CLASSES = [
  "paper sign in hand",
@@ -28,52 +33,111 @@ DEFAULT_OBJ_HEIGHTS_M = {
 }
 
 # ---------------- Utilities ----------------
-def _get_masks_resized(r, frame_hw: Tuple[int, int]) -> List[np.ndarray]:
+_PINNED = threading.local()   # per thread: .bufs = {slot -> reused page-locked host buffer}
+
+def _host_copy(t: torch.Tensor, slot: str) -> torch.Tensor:
+    """
+    Queue a non-blocking device->host copy of t into a reused page-locked buffer.
+    Buffers are per thread, so concurrent callers (several YoloeRealtime instances,
+    executor threads) never share one. The result is valid once the device stream is
+    synchronized, and only until this thread's next copy into the same slot; copy
+    anything that has to outlive that. CPU tensors are returned unchanged.
+    """
+    if not t.is_cuda:
+        return t
+    n = t.numel()
+    bufs = getattr(_PINNED, "bufs", None)
+    if bufs is None:
+        bufs = _PINNED.bufs = {}
+    buf = bufs.get(slot)
+    if buf is None or buf.dtype != t.dtype or buf.numel() < n:
+        buf = torch.empty(max(n, 1), dtype=t.dtype, pin_memory=True)
+        bufs[slot] = buf
+    host = buf[:n].view(t.shape)
+    host.copy_(t, non_blocking=True)
+    return host
+
+def _get_masks_resized(r, frame_hw: Tuple[int, int]) -> np.ndarray:
+    """
+    All instance masks as one (N, H, W) bool array at frame resolution.
+    Resizing is a single batched nearest-neighbour interpolate on the masks' own
+    device (GPU when inference ran there); only the final bool stack is copied to host,
+    through a reused pinned buffer. The returned array is owned by the caller.
+    """
     H, W = frame_hw
-    out = []
-    if getattr(r, "masks", None) is not None and r.masks is not None and getattr(r.masks, "data", None) is not None:
-        md = r.masks.data
-        try:
-            md = md.cpu().numpy()
-        except Exception:
-            md = np.array(md)
-        for mi in range(len(md)):
-            m = md[mi] > 0
-            if m.shape != (H, W):
-                m = cv2.resize(m.astype(np.uint8), (W, H), interpolation=cv2.INTER_NEAREST).astype(bool)
-            out.append(m)
-    return out
+    md = getattr(getattr(r, "masks", None), "data", None)
+    if md is None or len(md) == 0:
+        return np.zeros((0, H, W), dtype=bool)
+    if not isinstance(md, torch.Tensor):
+        md = torch.as_tensor(np.asarray(md))
+    m = md > 0
+    if tuple(m.shape[1:]) != (H, W):
+        m = F.interpolate(m[:, None].float(), size=(H, W), mode="nearest")[:, 0] > 0.5
+    host = _host_copy(m, "masks")
+    if m.is_cuda:
+        torch.cuda.current_stream(m.device).synchronize()  # also completes any copies queued before this one
+        return host.numpy().copy()  # detached from the staging buffer, which the next call overwrites
+    return host.numpy()
 
 def _parse_detections(r, classes: List[str], frame_hw: Tuple[int, int]) -> List[Dict[str, Any]]:
     H, W = frame_hw
     dets: List[Dict[str, Any]] = []
+    # Queue box/class D2H copies first so they overlap the mask resize; one stream sync covers all
+    boxes_h = clss_h = None
     if r.boxes is not None and len(r.boxes) > 0:
-        boxes = r.boxes.xyxy.cpu().numpy().astype(int)
-        clss  = r.boxes.cls.cpu().numpy().astype(int) if r.boxes.cls is not None else np.zeros((len(r.boxes),), int)
-    else:
-        boxes = np.empty((0,4), dtype=int); clss = np.empty((0,), dtype=int)
+        boxes_h = _host_copy(r.boxes.xyxy, "boxes")
+        clss_h  = _host_copy(r.boxes.cls, "cls") if r.boxes.cls is not None else None
 
     masks = _get_masks_resized(r, (H, W))
+    if boxes_h is not None and r.boxes.xyxy.is_cuda:
+        torch.cuda.current_stream(r.boxes.xyxy.device).synchronize()  # no-op if the mask copy already synced
 
-    for i, (x1,y1,x2,y2) in enumerate(boxes):
-        x1 = max(0, x1); y1 = max(0, y1); x2 = min(W-1, x2); y2 = min(H-1, y2)
-        if x2 <= x1 or y2 <= y1: 
-            continue
-        ci = int(clss[i]) if i < len(clss) else 0
-        label = classes[ci] if 0 <= ci < len(classes) else ""
-        cx, cy = (x1+x2)*0.5, (y1+y2)*0.5
+    if boxes_h is not None:
+        boxes = boxes_h.numpy().astype(int)
+        clss  = clss_h.numpy().astype(int) if clss_h is not None else np.zeros((len(boxes),), int)
+    else:
+        boxes = np.empty((0,4), dtype=int); clss = np.empty((0,), dtype=int)
+
+    # Clip, validate and compute centers for all boxes at once; dicts are built only for survivors
+    n = len(boxes)
+    x1 = np.maximum(boxes[:, 0], 0); y1 = np.maximum(boxes[:, 1], 0)
+    x2 = np.minimum(boxes[:, 2], W-1); y2 = np.minimum(boxes[:, 3], H-1)
+    keep = np.flatnonzero((x2 > x1) & (y2 > y1))
+    ci_all = np.zeros((n,), int); ci_all[:min(n, len(clss))] = clss[:n]
+    cx_all = (x1 + x2) * 0.5; cy_all = (y1 + y2) * 0.5
+
+    for i, ci, bx1, by1, bx2, by2, cx, cy in zip(keep.tolist(), ci_all[keep].tolist(),
+                                                 x1[keep].tolist(), y1[keep].tolist(),
+                                                 x2[keep].tolist(), y2[keep].tolist(),
+                                                 cx_all[keep].tolist(), cy_all[keep].tolist()):
         dets.append({
             "cls_idx": ci,
-            "label": label,
-            "bbox": (int(x1), int(y1), int(x2), int(y2)),
-            "center": (float(cx), float(cy)),
+            "label": classes[ci] if 0 <= ci < len(classes) else "",
+            "bbox": (bx1, by1, bx2, by2),
+            "center": (cx, cy),
             "mask": masks[i] if i < len(masks) else None,
         })
     return dets
 
-def _center_dist(a: Tuple[float,float], b: Tuple[float,float]) -> float:
-    ax, ay = a; bx, by = b
-    return float(np.hypot(ax-bx, ay-by))
+def _group_of(cls_to_group: np.ndarray, cls: np.ndarray) -> np.ndarray:
+    """Continuity group per class index (-1 = no group, including out-of-range indices)."""
+    ok = (cls >= 0) & (cls < len(cls_to_group))
+    return np.where(ok, cls_to_group[np.where(ok, cls, 0)], -1)
+
+def _match_cost_matrix(det_centers: np.ndarray, det_cls: np.ndarray,
+                       pool_centers: np.ndarray, pool_cls: np.ndarray, pool_last: np.ndarray,
+                       cls_to_group: np.ndarray, frame_idx: int,
+                       max_r2: float, max_age: int) -> np.ndarray:
+    """
+    (D, P) squared center distances between detections and pool items.
+    Pairs that fail the age, continuity-class or radius test are set to inf.
+    """
+    d2 = ((det_centers[:, None, :] - pool_centers[None, :, :]) ** 2).sum(axis=2)
+    age = frame_idx - pool_last
+    fresh = (age >= 0) & (age <= max_age)
+    g_det = _group_of(cls_to_group, det_cls); g_pool = _group_of(cls_to_group, pool_cls)
+    same = (det_cls[:, None] == pool_cls[None, :]) | ((g_det[:, None] >= 0) & (g_det[:, None] == g_pool[None, :]))
+    return np.where(same & fresh[None, :] & (d2 <= max_r2), d2, np.inf)
 
 def _fx_fy_from_fov(W: int, H: int, hfov_deg: float, vfov_deg: float) -> Tuple[float,float]:
     hf = math.radians(hfov_deg); vf = math.radians(vfov_deg)
@@ -86,44 +150,55 @@ def _rot_x(deg: float) -> np.ndarray:
     c, s = math.cos(t), math.sin(t)
     return np.array([[1,0,0],[0,c,-s],[0,s,c]], dtype=np.float32)
 
-def _depth_from_height_px(h_px: int, true_h_m: float, fy_px: float) -> float:
-    h = max(1, int(h_px))
-    return (fy_px * true_h_m) / float(h)
+def _estimate_3d_for_bboxes(bboxes: np.ndarray, labels: List[str], fx_px: float, fy_px: float,
+                            cx: float, cy: float, R_wc: np.ndarray, cam_pos_w: np.ndarray,
+                            obj_heights: Dict[str, float]) -> np.ndarray:
+    """
+    Back-project all detections of a frame at once from their bottom-center pixel and
+    known object height. Returns (N, 6) float64 rows of Xc, Yc, Zc, Xw, Yw, Zw;
+    rows for labels without a known height are NaN.
+    """
+    bb = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    true_h = np.array([obj_heights.get(l, np.nan) for l in labels], dtype=np.float64)
+    h_px = np.maximum(1.0, bb[:, 3] - bb[:, 1])
+    u = (bb[:, 0] + bb[:, 2]) * 0.5   # bottom center
+    v = bb[:, 3]
 
-def _cam_xy_from_pixel(u: float, v: float, Zc: float, fx_px: float, fy_px: float, cx: float, cy: float) -> Tuple[float,float]:
+    Zc = fy_px * true_h / h_px
     Xc = (u - cx) * Zc / fx_px
     Yc = (v - cy) * Zc / fy_px
-    return float(Xc), float(Yc)
-
-def _estimate_3d_for_bbox(bbox: Tuple[int,int,int,int], label: str, fx_px: float, fy_px: float,
-                          cx: float, cy: float, R_wc: np.ndarray, cam_pos_w: np.ndarray,
-                          obj_heights: Dict[str, float]) -> Dict[str, float]:
-    x1,y1,x2,y2 = bbox
-    h_px = max(1, y2 - y1)
-    u = (x1 + x2) * 0.5   # bottom center
-    v = float(y2)
-
-    true_h = obj_heights.get(label, None)
-    if true_h is None:
-        return {}
-
-    Zc = _depth_from_height_px(h_px, true_h, fy_px)
-    Xc, Yc = _cam_xy_from_pixel(u, v, Zc, fx_px, fy_px, cx, cy)
-    pc = np.array([Xc, Yc, Zc], dtype=np.float32)
-    pw = cam_pos_w + R_wc @ pc
-    return {"Xc": float(Xc), "Yc": float(Yc), "Zc": float(Zc),
-            "Xw": float(pw[0]), "Yw": float(pw[1]), "Zw": float(pw[2])}
+    pc = np.stack([Xc, Yc, Zc])                                       # (3, N)
+    pw = cam_pos_w.astype(np.float64)[:, None] + R_wc.astype(np.float64) @ pc
+    return np.concatenate([pc, pw]).T
 
 # ---------------- Identity Manager (radius+time+continuity only) ----------------
+_SLOT_FREE, _SLOT_ACTIVE, _SLOT_INACTIVE = 0, 1, 2
+
+# Pools smaller than this are matched brute force; larger ones go through the uniform grid first
+_GRID_MIN_POOL = 32
+_GRID_KEY_STRIDE = 1 << 32
+_GRID_NEIGHBOURS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)], dtype=np.int64)
+
 class IdentityManager:
+    """
+    Track records are stored structure-of-arrays: one row ("slot") per known gid,
+    with parallel arrays for center/bbox/class/last-seen and a state per slot
+    (free / active / inactive). Freed slots are recycled through a free-list.
+    """
     def __init__(self, classes: List[str], continuity_groups: List[set], 
-                 reid_max_radius_px: int, reid_max_frames: int):
+                 reid_max_radius_px: int, reid_max_frames: int, capacity: int = 64):
         self.classes = classes
         self.reid_max_radius_px = reid_max_radius_px
         self.reid_max_frames = reid_max_frames
         self.next_gid = 0
-        self.active: Dict[int, Dict[str, Any]] = {}    # gid -> {cls, bbox, center, last_frame}
-        self.inactive: List[Dict[str, Any]] = []       # [{gid, cls, bbox, center, last_frame}]
+
+        self.gids    = np.zeros(capacity, dtype=np.int64)
+        self.centers = np.zeros((capacity, 2), dtype=np.float32)
+        self.bboxes  = np.zeros((capacity, 4), dtype=np.int32)
+        self.cls     = np.zeros(capacity, dtype=np.int64)
+        self.last    = np.zeros(capacity, dtype=np.int64)
+        self.state   = np.full(capacity, _SLOT_FREE, dtype=np.int8)
+        self.free_slots: List[int] = list(range(capacity - 1, -1, -1))
 
         # Build continuity group map: class index -> group id
         self.cls_group: Dict[int, int] = {}
@@ -135,141 +210,120 @@ class IdentityManager:
                 for ci in indices:
                     self.cls_group[ci] = group_id
                 group_id += 1
-
-    def _same_continuity_class(self, ci_a: int, ci_b: int) -> bool:
-        if ci_a == ci_b: 
-            return True
-        ga = self.cls_group.get(ci_a, None)
-        gb = self.cls_group.get(ci_b, None)
-        return ga is not None and ga == gb
-
-    def _new_gid(self, cls_idx: int, bbox, center, frame_idx: int) -> int:
+        # Same map as a lookup table for the vectorized matcher (-1 = no group)
+        self.cls_to_group = np.full(max(1, len(self.classes)), -1, dtype=np.int64)
+        for ci, g in self.cls_group.items():
+            self.cls_to_group[ci] = g
+
+    def _grow(self):
+        n = len(self.state)
+        self.gids    = np.concatenate([self.gids,    np.zeros(n, dtype=np.int64)])
+        self.centers = np.concatenate([self.centers, np.zeros((n, 2), dtype=np.float32)])
+        self.bboxes  = np.concatenate([self.bboxes,  np.zeros((n, 4), dtype=np.int32)])
+        self.cls     = np.concatenate([self.cls,     np.zeros(n, dtype=np.int64)])
+        self.last    = np.concatenate([self.last,    np.zeros(n, dtype=np.int64)])
+        self.state   = np.concatenate([self.state,   np.full(n, _SLOT_FREE, dtype=np.int8)])
+        self.free_slots.extend(range(2 * n - 1, n - 1, -1))
+
+    def _touch(self, slot: int, det: Dict[str, Any], frame_idx: int):
+        """Refresh a slot from a matched detection and mark it active (class is kept)."""
+        self.centers[slot] = det["center"]
+        self.bboxes[slot] = det["bbox"]
+        self.last[slot] = frame_idx
+        self.state[slot] = _SLOT_ACTIVE
+
+    def _new_gid(self, cls_idx: int, bbox, center, frame_idx: int) -> Tuple[int, int]:
+        if not self.free_slots:
+            self._grow()
+        slot = self.free_slots.pop()
         gid = self.next_gid; self.next_gid += 1
-        self.active[gid] = {"cls": cls_idx, "bbox": bbox, "center": center, "last_frame": frame_idx}
-        return gid
-
-    def _match_pool(self, det, pool, frame_idx) -> Optional[int]:
-        ci = det["cls_idx"]; dc = det["center"]
-        best_gid, best_dist, best_pos = None, float("inf"), -1
-        for idx, item in enumerate(pool):
-            age = frame_idx - item["last_frame"]
-            if age < 0 or age > self.reid_max_frames:
-                continue
-            if not self._same_continuity_class(item["cls"], ci):
-                continue
-            dist = _center_dist(dc, item["center"])
-            if dist <= self.reid_max_radius_px and dist < best_dist:
-                best_gid, best_dist, best_pos = item["gid"], dist, idx
-        if best_gid is None:
-            return None
-        item = pool.pop(best_pos)
-        self.active[best_gid] = {
-            "cls": item["cls"],
-            "bbox": det["bbox"],
-            "center": det["center"],
-            "last_frame": frame_idx
-        }
-        return best_gid
-    
-
-    def _match_pool(self, det, pool, frame_idx):
-        ci = det["cls_idx"]; dc = det["center"]
-        best_gid, best_dist, best_pos = None, float("inf"), -1
-        for idx, item in enumerate(pool):
-            age = frame_idx - item["last_frame"]
-            if age < 0 or age > self.reid_max_frames:
-                continue
-            if not self._same_continuity_class(item["cls"], ci):
+        self.gids[slot] = gid
+        self.cls[slot] = cls_idx
+        self.centers[slot] = center
+        self.bboxes[slot] = bbox
+        self.last[slot] = frame_idx
+        self.state[slot] = _SLOT_ACTIVE
+        return gid, slot
+
+    def _grid_candidates(self, det_centers: np.ndarray, slots: np.ndarray) -> np.ndarray:
+        """
+        Uniform-grid prefilter (cell size = re-ID radius): keep only pool slots whose cell
+        is in the 3x3 neighbourhood of some detection's cell. Anything farther is beyond
+        the radius anyway. Slot order is preserved so tie-breaking is unchanged.
+        """
+        cell = float(max(1, self.reid_max_radius_px))
+        pcell = np.floor(self.centers[slots] / cell).astype(np.int64)
+        dcell = np.floor(det_centers / cell).astype(np.int64)
+        pkeys = pcell[:, 0] * _GRID_KEY_STRIDE + pcell[:, 1]
+        order = np.argsort(pkeys, kind="stable"); sorted_keys = pkeys[order]
+        q = (dcell[:, None, :] + _GRID_NEIGHBOURS[None, :, :]).reshape(-1, 2)
+        qkeys = np.unique(q[:, 0] * _GRID_KEY_STRIDE + q[:, 1])
+        lo = np.searchsorted(sorted_keys, qkeys, side="left")
+        hi = np.searchsorted(sorted_keys, qkeys, side="right")
+        hit = [order[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a]
+        if not hit:
+            return slots[:0]
+        return slots[np.sort(np.concatenate(hit))]
+
+    def _match_pool(self, det_centers: np.ndarray, det_cls: np.ndarray, det_idx: List[int],
+                    slots: np.ndarray, frame_idx: int) -> List[Tuple[int, int]]:
+        """
+        Greedy nearest-center match of detections det_idx against pool slots, in detection order.
+        Returns (det index, slot) pairs; each slot is used at most once.
+        No side effects: the caller accepts the pairs.
+        """
+        if not det_idx or len(slots) == 0:
+            return []
+        if len(slots) >= _GRID_MIN_POOL:
+            slots = self._grid_candidates(det_centers[det_idx], slots)
+            if len(slots) == 0:
+                return []
+        cost = _match_cost_matrix(
+            det_centers[det_idx], det_cls[det_idx],
+            self.centers[slots], self.cls[slots], self.last[slots],
+            self.cls_to_group, frame_idx,
+            float(self.reid_max_radius_px) ** 2, self.reid_max_frames)
+        pairs = []
+        for row, i in enumerate(det_idx):
+            pos = int(np.argmin(cost[row]))
+            if not np.isfinite(cost[row, pos]):
                 continue
-            dist = _center_dist(dc, item["center"])
-            if dist <= self.reid_max_radius_px and dist < best_dist:
-                best_gid, best_dist, best_pos = item["gid"], dist, idx
-        # IMPORTANT: no side effects here
-        if best_gid is None:
-            return None
-        return best_gid, best_pos
-
-
-    def assign(self, frame_idx: int, dets: List[Dict[str, Any]]) -> Dict[int, int]:
-        used_gids = set(); idx_to_gid: Dict[int, int] = {}
-
-        # Try active first
-        for i, det in enumerate(dets):
-            gid = self._match_pool(det, pool=[{"gid": gid, **rec} for gid, rec in self.active.items()], frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid); idx_to_gid[i] = gid
-
-        # Then inactive
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: continue
-            gid = self._match_pool(det, pool=self.inactive, frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid); idx_to_gid[i] = gid
-
-        # New IDs
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: continue
-            gid = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
-            used_gids.add(gid); idx_to_gid[i] = gid
+            cost[:, pos] = np.inf  # consumed by this detection
+            pairs.append((i, int(slots[pos])))
+        return pairs
 
-        # Move unmatched actives to inactive and prune stale
-        updated = set(idx_to_gid.values())
-        for gid in list(self.active.keys()):
-            if gid not in updated:
-                rec = self.active.pop(gid)
-                self.inactive.append({"gid": gid, **rec})
-        self.inactive = [it for it in self.inactive if (frame_idx - it["last_frame"]) <= self.reid_max_frames]
-        return idx_to_gid
-    
     def assign(self, frame_idx: int, dets: List[Dict[str, Any]]) -> Dict[int, int]:
-        used_gids = set(); idx_to_gid: Dict[int, int] = {}
+        idx_to_gid: Dict[int, int] = {}
+        matched = np.zeros(len(self.state), dtype=bool)
 
-        # Build shared pools ONCE
-        active_pool = [{"gid": gid, **rec} for gid, rec in self.active.items()]  # shared
-        inactive_pool = self.inactive  # already shared list
+        det_centers = np.array([d["center"] for d in dets], dtype=np.float32).reshape(-1, 2)
+        det_cls = np.array([d["cls_idx"] for d in dets], dtype=np.int64)
 
-        # Try ACTIVE first (no side effects until we accept)
-        for i, det in enumerate(dets):
-            m = self._match_pool(det, pool=active_pool, frame_idx=frame_idx)
-            if m is None:
-                continue
-            gid, pos = m
-            if gid in used_gids:
-                continue  # don't accept; crucially, no mutation has happened
-            # accept: remove from active_pool, update self.active
-            item = active_pool.pop(pos)
-            self.active[gid] = {"cls": item["cls"], "bbox": det["bbox"], "center": det["center"], "last_frame": frame_idx}
-            used_gids.add(gid); idx_to_gid[i] = gid
-
-        # Then INACTIVE (again, no side effects until we accept)
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: 
-                continue
-            m = self._match_pool(det, pool=inactive_pool, frame_idx=frame_idx)
-            if m is None:
-                continue
-            gid, pos = m
-            if gid in used_gids:
-                continue
-            # accept: remove from INACTIVE and activate it
-            item = inactive_pool.pop(pos)
-            self.active[gid] = {"cls": item["cls"], "bbox": det["bbox"], "center": det["center"], "last_frame": frame_idx}
-            used_gids.add(gid); idx_to_gid[i] = gid
+        # Try ACTIVE first, then INACTIVE (accepted inactive slots are re-activated)
+        for pool_state in (_SLOT_ACTIVE, _SLOT_INACTIVE):
+            rest = [i for i in range(len(dets)) if i not in idx_to_gid]
+            slots = np.flatnonzero(self.state == pool_state)
+            for i, slot in self._match_pool(det_centers, det_cls, rest, slots, frame_idx):
+                self._touch(slot, dets[i], frame_idx)
+                matched[slot] = True
+                idx_to_gid[i] = int(self.gids[slot])
 
         # New IDs
         for i, det in enumerate(dets):
             if i in idx_to_gid: 
                 continue
-            gid = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
-            used_gids.add(gid); idx_to_gid[i] = gid
+            gid, slot = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
+            if slot >= len(matched):
+                matched = np.concatenate([matched, np.zeros(len(self.state) - len(matched), dtype=bool)])
+            matched[slot] = True
+            idx_to_gid[i] = gid
 
         # Move unmatched actives to inactive and prune stale
-        matched_gids = set(idx_to_gid.values())
-        for gid in list(self.active.keys()):
-            if gid not in matched_gids:
-                rec = self.active.pop(gid)
-                self.inactive.append({"gid": gid, **rec})
-        self.inactive = [it for it in self.inactive if (frame_idx - it["last_frame"]) <= self.reid_max_frames]
+        self.state[(self.state == _SLOT_ACTIVE) & ~matched] = _SLOT_INACTIVE
+        stale = np.flatnonzero((self.state == _SLOT_INACTIVE) & ((frame_idx - self.last) > self.reid_max_frames))
+        if len(stale):
+            self.state[stale] = _SLOT_FREE
+            self.free_slots.extend(stale.tolist())
         return idx_to_gid
 
 
@@ -338,40 +392,60 @@ class YoloeRealtime:
         """
         Run YOLOE on a single BGR frame.
         Returns (json_list, vis_frame) where vis_frame is None if return_vis=False.
+        With no detections, vis_frame is frame_bgr itself rather than a copy.
         """
         if frame_bgr is None or frame_bgr.size == 0:
             return [], None
+        return self.process_frames([frame_bgr], return_vis)[0]
+
+    def process_frames(self, frames_bgr: List[np.ndarray], return_vis: bool = False) -> List[Tuple[List[Dict[str, Any]], Optional[np.ndarray]]]:
+        """
+        Run YOLOE on several BGR frames in one batched forward pass.
+        ID assignment then runs per frame in input order, exactly as if process_frame
+        had been called on each one. Empty/None frames yield ([], None) and do not advance frame_idx.
+        """
+        out: List[Tuple[List[Dict[str, Any]], Optional[np.ndarray]]] = [([], None) for _ in frames_bgr]
+        valid = [i for i, f in enumerate(frames_bgr) if f is not None and f.size > 0]
+        if not valid:
+            return out
 
-        H, W = frame_bgr.shape[:2]
         if self.fx is None:
+            H, W = frames_bgr[valid[0]].shape[:2]
             self.fx, self.fy = _fx_fy_from_fov(W, H, self.hfov_deg, self.vfov_deg)
             self.cx, self.cy = W/2.0, H/2.0
 
-        # Predict on this frame
+        # Predict on all frames at once
         results = self.model.predict(
-            source=frame_bgr,
+            source=[frames_bgr[i] for i in valid],
             imgsz=self.imgsz, conf=self.conf, iou=self.iou,
             device=self.device, half=self.use_half, verbose=False
         )
-        r = results[0]
+        for i, r in zip(valid, results):
+            out[i] = self._process_result(frames_bgr[i], r, return_vis)
+        return out
+
+    def _process_result(self, frame_bgr: np.ndarray, r, return_vis: bool) -> Tuple[List[Dict[str, Any]], Optional[np.ndarray]]:
+        """Parse one prediction result, assign IDs, build JSON and (optionally) the visualization."""
+        H, W = frame_bgr.shape[:2]
 
         # Parse + assign IDs
         dets = _parse_detections(r, self.classes, (H, W))
         idx_to_gid = self.idman.assign(self.frame_idx, dets)
 
-        # Build JSON + (optional) visualization
+        # Build JSON (3D coordinates for all detections in one pass)
         json_list: List[Dict[str, Any]] = []
-        overlay = frame_bgr.copy() if return_vis else None  # <— build overlay first
+        coords = [[None] * 6] * len(dets)
+        if dets and (self.fx is not None) and (self.fy is not None):
+            xyz = _estimate_3d_for_bboxes([d["bbox"] for d in dets], [d["label"] for d in dets],
+                                          self.fx, self.fy, self.cx, self.cy,
+                                          self.R_wc, self.cam_pos_w, self.obj_heights_m)
+            known = ~np.isnan(xyz[:, 2])
+            coords = [row if ok else [None] * 6 for row, ok in zip(xyz.tolist(), known.tolist())]
 
         for i, det in enumerate(dets):
             gid = idx_to_gid[i]
             (x1,y1,x2,y2) = det["bbox"]; (cx_px,cy_px) = det["center"]
-
-            coords = {}
-            if (self.fx is not None) and (self.fy is not None):
-                coords = _estimate_3d_for_bbox(det["bbox"], det["label"], 
-                                            self.fx, self.fy, self.cx, self.cy,
-                                            self.R_wc, self.cam_pos_w, self.obj_heights_m)
+            Xc, Yc, Zc, Xw, Yw, Zw = coords[i]
 
             obj = {
                 "frame": int(self.frame_idx),
@@ -379,45 +453,38 @@ class YoloeRealtime:
                 "label": det["label"],
                 "x1": int(x1), "y1": int(y1), "x2": int(x2), "y2": int(y2),
                 "cx": float(cx_px), "cy": float(cy_px),
-                "Xc": coords.get("Xc", None),
-                "Yc": coords.get("Yc", None),
-                "Zc": coords.get("Zc", None),
-                "Xw": coords.get("Xw", None),
-                "Yw": coords.get("Yw", None),
-                "Zw": coords.get("Zw", None)
+                "Xc": Xc, "Yc": Yc, "Zc": Zc,
+                "Xw": Xw, "Yw": Yw, "Zw": Zw
             }
             json_list.append(obj)
 
-            if return_vis:
-                col = (
-                    60 + (37 * (gid + 1)) % 195,
-                    60 + (91 * (gid + 1)) % 195,
-                    60 + (13 * (gid + 1)) % 195
-                )
-                m = det.get("mask", None)
-                if m is not None and m.shape == frame_bgr.shape[:2]:
-                    overlay[m] = col  # paint onto overlay only
-
-        # After mask painting, blend once, then draw crisp boxes/labels
+        # (Optional) visualization: one compositing pass for all masks, then crisp boxes/labels
         vis = None
-        if return_vis:
-            vis = cv2.addWeighted(overlay, 0.35, frame_bgr, 0.65, 0.0)
+        if return_vis and not dets:
+            vis = frame_bgr  # nothing to draw: hand back the input frame instead of copying it
+        elif return_vis:
+            vis = frame_bgr.copy()
+            painted = [(idx_to_gid[i], det["mask"]) for i, det in enumerate(dets)
+                       if det.get("mask", None) is not None and det["mask"].shape == frame_bgr.shape[:2]]
+            if painted:
+                stack = np.stack([m for _, m in painted])           # (N, H, W) bool
+                covered = stack.any(axis=0)                          # (H, W)
+                if covered.any():
+                    # per covered pixel, the last mask that hits it wins (same as sequential painting)
+                    hits = stack[:, covered]                         # (N, K)
+                    top = len(painted) - 1 - np.argmax(hits[::-1], axis=0)
+                    palette = GID_PALETTE[np.array([gid for gid, _ in painted]) % len(GID_PALETTE)]
+                    vis[covered] = cv2.addWeighted(palette[top], 0.35, frame_bgr[covered], 0.65, 0.0)
 
             for i, det in enumerate(dets):
                 gid = idx_to_gid[i]
                 (x1,y1,x2,y2) = det["bbox"]; (cx_px,cy_px) = det["center"]
-                col = (
-                    60 + (37 * (gid + 1)) % 195,
-                    60 + (91 * (gid + 1)) % 195,
-                    60 + (13 * (gid + 1)) % 195
-                )
+                col = color_for_gid(gid)
                 cv2.rectangle(vis, (x1,y1), (x2,y2), col, 2)
                 tag = f"{det['label']}  id:{gid}"
                 ytxt = max(12, y1 - 6)
-                cv2.putText(vis, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (20,20,20), 2, cv2.LINE_AA)
-                cv2.putText(vis, tag, (x1, ytxt), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
+                draw_label(vis, tag, (x1, ytxt), 0.5, (255,255,255), (20,20,20))
                 cv2.circle(vis, (int(cx_px), int(cy_px)), 3, (255,255,255), -1)
 
-
         self.frame_idx += 1
         return json_list, vis
@@ -8,6 +8,9 @@ import cv2
 import numpy as np
 from ultralytics import YOLOE
 
+from vis_utils import GID_PALETTE, color_for_gid
+from yoloe_rt import IdentityManager, _parse_detections, _estimate_3d_for_bboxes
+
 # ---------------- Defaults / Config Structs ----------------
 DEFAULT_CLASSES = [
     "white bottle", "paper sign in hand", "paper air plane",
@@ -35,53 +38,6 @@ TELEPORT_THRESH_PX    = 300.0 # pixel jump that resets smoothing (center-based)
 TELEPORT_THRESH_M     = 1.5   # world jump (meters) that resets smoothing
 
 # ---------------- Utilities ----------------
-def _get_masks_resized(r, frame_hw: Tuple[int, int]) -> List[np.ndarray]:
-    H, W = frame_hw
-    out = []
-    if getattr(r, "masks", None) is not None and r.masks is not None and getattr(r.masks, "data", None) is not None:
-        md = r.masks.data
-        try:
-            md = md.cpu().numpy()
-        except Exception:
-            md = np.array(md)
-        for mi in range(len(md)):
-            m = md[mi] > 0
-            if m.shape != (H, W):
-                m = cv2.resize(m.astype(np.uint8), (W, H), interpolation=cv2.INTER_NEAREST).astype(bool)
-            out.append(m)
-    return out
-
-def _parse_detections(r, classes: List[str], frame_hw: Tuple[int, int]) -> List[Dict[str, Any]]:
-    H, W = frame_hw
-    dets: List[Dict[str, Any]] = []
-    if r.boxes is not None and len(r.boxes) > 0:
-        boxes = r.boxes.xyxy.cpu().numpy().astype(int)
-        clss  = r.boxes.cls.cpu().numpy().astype(int) if r.boxes.cls is not None else np.zeros((len(r.boxes),), int)
-    else:
-        boxes = np.empty((0,4), dtype=int); clss = np.empty((0,), dtype=int)
-
-    masks = _get_masks_resized(r, (H, W))
-
-    for i, (x1,y1,x2,y2) in enumerate(boxes):
-        x1 = max(0, x1); y1 = max(0, y1); x2 = min(W-1, x2); y2 = min(H-1, y2)
-        if x2 <= x1 or y2 <= y1: 
-            continue
-        ci = int(clss[i]) if i < len(clss) else 0
-        label = classes[ci] if 0 <= ci < len(classes) else ""
-        cx, cy = (x1+x2)*0.5, (y1+y2)*0.5
-        dets.append({
-            "cls_idx": ci,
-            "label": label,
-            "bbox": (int(x1), int(y1), int(x2), int(y2)),
-            "center": (float(cx), float(cy)),
-            "mask": masks[i] if i < len(masks) else None,
-        })
-    return dets
-
-def _center_dist(a: Tuple[float,float], b: Tuple[float,float]) -> float:
-    ax, ay = a; bx, by = b
-    return float(np.hypot(ax-bx, ay-by))
-
 def _fx_fy_from_fov(W: int, H: int, hfov_deg: float, vfov_deg: float) -> Tuple[float,float]:
     hf = math.radians(hfov_deg); vf = math.radians(vfov_deg)
     fx = (W/2.0) / math.tan(hf/2.0)
@@ -93,122 +49,6 @@ def _rot_x(deg: float) -> np.ndarray:
     c, s = math.cos(t), math.sin(t)
     return np.array([[1,0,0],[0,c,-s],[0,s,c]], dtype=np.float32)
 
-def _depth_from_height_px(h_px: int, true_h_m: float, fy_px: float) -> float:
-    h = max(1, int(h_px))
-    return (fy_px * true_h_m) / float(h)
-
-def _cam_xy_from_pixel(u: float, v: float, Zc: float, fx_px: float, fy_px: float, cx: float, cy: float) -> Tuple[float,float]:
-    Xc = (u - cx) * Zc / fx_px
-    Yc = (v - cy) * Zc / fy_px
-    return float(Xc), float(Yc)
-
-def _estimate_3d_for_bbox(bbox: Tuple[int,int,int,int], label: str, fx_px: float, fy_px: float,
-                          cx: float, cy: float, R_wc: np.ndarray, cam_pos_w: np.ndarray,
-                          obj_heights: Dict[str, float]) -> Dict[str, float]:
-    x1,y1,x2,y2 = bbox
-    h_px = max(1, y2 - y1)
-    u = (x1 + x2) * 0.5   # bottom center
-    v = float(y2)
-
-    true_h = obj_heights.get(label, None)
-    if true_h is None:
-        return {}
-
-    Zc = _depth_from_height_px(h_px, true_h, fy_px)
-    Xc, Yc = _cam_xy_from_pixel(u, v, Zc, fx_px, fy_px, cx, cy)
-    pc = np.array([Xc, Yc, Zc], dtype=np.float32)
-    pw = cam_pos_w + R_wc @ pc
-    return {"Xc": float(Xc), "Yc": float(Yc), "Zc": float(Zc),
-            "Xw": float(pw[0]), "Yw": float(pw[1]), "Zw": float(pw[2])}
-
-# ---------------- Identity Manager (radius+time+continuity only) ----------------
-class IdentityManager:
-    def __init__(self, classes: List[str], continuity_groups: List[set], 
-                 reid_max_radius_px: int, reid_max_frames: int):
-        self.classes = classes
-        self.reid_max_radius_px = reid_max_radius_px
-        self.reid_max_frames = reid_max_frames
-        self.next_gid = 0
-        self.active: Dict[int, Dict[str, Any]] = {}    # gid -> {cls, bbox, center, last_frame}
-        self.inactive: List[Dict[str, Any]] = []       # [{gid, cls, bbox, center, last_frame}]
-
-        # Build continuity group map: class index -> group id
-        self.cls_group: Dict[int, int] = {}
-        group_id = 0
-        name_to_idx = {name: i for i, name in enumerate(self.classes)}
-        for group in continuity_groups:
-            indices = [name_to_idx[n] for n in group if n in name_to_idx]
-            if len(indices) >= 2:
-                for ci in indices:
-                    self.cls_group[ci] = group_id
-                group_id += 1
-
-    def _same_continuity_class(self, ci_a: int, ci_b: int) -> bool:
-        if ci_a == ci_b: 
-            return True
-        ga = self.cls_group.get(ci_a, None)
-        gb = self.cls_group.get(ci_b, None)
-        return ga is not None and ga == gb
-
-    def _new_gid(self, cls_idx: int, bbox, center, frame_idx: int) -> int:
-        gid = self.next_gid; self.next_gid += 1
-        self.active[gid] = {"cls": cls_idx, "bbox": bbox, "center": center, "last_frame": frame_idx}
-        return gid
-
-    def _match_pool(self, det, pool, frame_idx) -> Optional[int]:
-        ci = det["cls_idx"]; dc = det["center"]
-        best_gid, best_dist, best_pos = None, float("inf"), -1
-        for idx, item in enumerate(pool):
-            age = frame_idx - item["last_frame"]
-            if age < 0 or age > self.reid_max_frames:
-                continue
-            if not self._same_continuity_class(item["cls"], ci):
-                continue
-            dist = _center_dist(dc, item["center"])
-            if dist <= self.reid_max_radius_px and dist < best_dist:
-                best_gid, best_dist, best_pos = item["gid"], dist, idx
-        if best_gid is None:
-            return None
-        item = pool.pop(best_pos)
-        self.active[best_gid] = {
-            "cls": item["cls"],
-            "bbox": det["bbox"],
-            "center": det["center"],
-            "last_frame": frame_idx
-        }
-        return best_gid
-
-    def assign(self, frame_idx: int, dets: List[Dict[str, Any]]) -> Dict[int, int]:
-        used_gids = set(); idx_to_gid: Dict[int, int] = {}
-
-        # Try active first
-        for i, det in enumerate(dets):
-            gid = self._match_pool(det, pool=[{"gid": gid, **rec} for gid, rec in self.active.items()], frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid); idx_to_gid[i] = gid
-
-        # Then inactive
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: continue
-            gid = self._match_pool(det, pool=self.inactive, frame_idx=frame_idx)
-            if gid is not None and gid not in used_gids:
-                used_gids.add(gid); idx_to_gid[i] = gid
-
-        # New IDs
-        for i, det in enumerate(dets):
-            if i in idx_to_gid: continue
-            gid = self._new_gid(det["cls_idx"], det["bbox"], det["center"], frame_idx)
-            used_gids.add(gid); idx_to_gid[i] = gid
-
-        # Move unmatched actives to inactive and prune stale
-        updated = set(idx_to_gid.values())
-        for gid in list(self.active.keys()):
-            if gid not in updated:
-                rec = self.active.pop(gid)
-                self.inactive.append({"gid": gid, **rec})
-        self.inactive = [it for it in self.inactive if (frame_idx - it["last_frame"]) <= self.reid_max_frames]
-        return idx_to_gid
-
 # ---------------- Direction-aware Smoother → Replaced with simple EMA ----------------
 class _TrackSmoother:
     """
@@ -342,6 +182,7 @@ class YoloeRealtime:
         """
         Run YOLOE on a single BGR frame.
         Returns (json_list, vis_frame) where vis_frame is None if return_vis=False.
+        With no detections, vis_frame is frame_bgr itself rather than a copy.
         """
         if frame_bgr is None or frame_bgr.size == 0:
             return [], None
@@ -363,19 +204,20 @@ class YoloeRealtime:
         dets = _parse_detections(r, self.classes, (H, W))
         idx_to_gid = self.idman.assign(self.frame_idx, dets)
 
-        # Build JSON + (optional) visualization
+        # Build JSON (3D coordinates for all detections in one pass)
         json_list: List[Dict[str, Any]] = []
-        overlay = frame_bgr.copy() if return_vis else None  # <— build overlay first
+        coords = [[None] * 6] * len(dets)
+        if dets and (self.fx is not None) and (self.fy is not None):
+            xyz = _estimate_3d_for_bboxes([d["bbox"] for d in dets], [d["label"] for d in dets],
+                                          self.fx, self.fy, self.cx, self.cy,
+                                          self.R_wc, self.cam_pos_w, self.obj_heights_m)
+            known = ~np.isnan(xyz[:, 2])
+            coords = [row if ok else [None] * 6 for row, ok in zip(xyz.tolist(), known.tolist())]
 
         for i, det in enumerate(dets):
             gid = idx_to_gid[i]
             (x1,y1,x2,y2) = det["bbox"]; (cx_px,cy_px) = det["center"]
-
-            coords = {}
-            if (self.fx is not None) and (self.fy is not None):
-                coords = _estimate_3d_for_bbox(det["bbox"], det["label"], 
-                                            self.fx, self.fy, self.cx, self.cy,
-                                            self.R_wc, self.cam_pos_w, self.obj_heights_m)
+            Xc, Yc, Zc, Xw, Yw, Zw = coords[i]
 
             obj = {
                 "frame": int(self.frame_idx),
@@ -383,38 +225,33 @@ class YoloeRealtime:
                 "label": det["label"],
                 "x1": int(x1), "y1": int(y1), "x2": int(x2), "y2": int(y2),
                 "cx": float(cx_px), "cy": float(cy_px),
-                "Xc": coords.get("Xc", None),
-                "Yc": coords.get("Yc", None),
-                "Zc": coords.get("Zc", None),
-                "Xw": coords.get("Xw", None),
-                "Yw": coords.get("Yw", None),
-                "Zw": coords.get("Zw", None)
+                "Xc": Xc, "Yc": Yc, "Zc": Zc,
+                "Xw": Xw, "Yw": Yw, "Zw": Zw
             }
             json_list.append(obj)
 
-            if return_vis:
-                col = (
-                    60 + (37 * (gid + 1)) % 195,
-                    60 + (91 * (gid + 1)) % 195,
-                    60 + (13 * (gid + 1)) % 195
-                )
-                m = det.get("mask", None)
-                if m is not None and m.shape == frame_bgr.shape[:2]:
-                    overlay[m] = col  # paint onto overlay only
-
-        # After mask painting, blend once, then draw crisp boxes/labels
+        # Blend only the mask-covered pixels in one pass, then draw crisp boxes/labels
         vis = None
-        if return_vis:
-            vis = cv2.addWeighted(overlay, 0.35, frame_bgr, 0.65, 0.0)
+        if return_vis and not dets:
+            vis = frame_bgr  # nothing to draw: hand back the input frame instead of copying it
+        elif return_vis:
+            vis = frame_bgr.copy()
+            painted = [(idx_to_gid[i], det["mask"]) for i, det in enumerate(dets)
+                       if det.get("mask", None) is not None and det["mask"].shape == frame_bgr.shape[:2]]
+            if painted:
+                stack = np.stack([m for _, m in painted])           # (N, H, W) bool
+                covered = stack.any(axis=0)                          # (H, W)
+                if covered.any():
+                    # per covered pixel, the last mask that hits it wins (same as sequential painting)
+                    hits = stack[:, covered]                         # (N, K)
+                    top = len(painted) - 1 - np.argmax(hits[::-1], axis=0)
+                    palette = GID_PALETTE[np.array([gid for gid, _ in painted]) % len(GID_PALETTE)]
+                    vis[covered] = cv2.addWeighted(palette[top], 0.35, frame_bgr[covered], 0.65, 0.0)
 
             for i, det in enumerate(dets):
                 gid = idx_to_gid[i]
                 (x1,y1,x2,y2) = det["bbox"]; (cx_px,cy_px) = det["center"]
-                col = (
-                    60 + (37 * (gid + 1)) % 195,
-                    60 + (91 * (gid + 1)) % 195,
-                    60 + (13 * (gid + 1)) % 195
-                )
+                col = color_for_gid(gid)
                 cv2.rectangle(vis, (x1,y1), (x2,y2), col, 2)
                 tag = f"{det['label']}  id:{gid}"
                 ytxt = max(12, y1 - 6)
@@ -6,6 +6,7 @@ import (
 	"fmt"
 	"log"
 	"net/http"
+	"strconv"
 	"sync"
 	"time"
 
@@ -358,6 +359,46 @@ func (ss *StreamServer) handleGetLatestFrame(w http.ResponseWriter, r *http.Requ
 	})
 }
 
+// handleGetLatestFrameJPEG serves the latest frame as raw JPEG bytes (no JSON, no base64).
+func (ss *StreamServer) handleGetLatestFrameJPEG(w http.ResponseWriter, r *http.Request) {
+	clientID := mux.Vars(r)["id"]
+	client, ok := ss.GetClient(clientID)
+	if !ok {
+		http.NotFound(w, r)
+		return
+	}
+	frame := client.Buffer.GetLatest()
+	if frame == nil {
+		http.NotFound(w, r)
+		return
+	}
+	w.Header().Set("Content-Type", "image/jpeg")
+	w.Header().Set("Content-Length", strconv.Itoa(len(frame.Data)))
+	w.Header().Set("X-Frame-Timestamp", frame.Timestamp.Format(time.RFC3339Nano))
+	w.Write(frame.Data)
+}
+
+func (ss *StreamServer) handleGetLatestFrameMeta(w http.ResponseWriter, r *http.Request) {
+	clientID := mux.Vars(r)["id"]
+	client, ok := ss.GetClient(clientID)
+	if !ok {
+		http.NotFound(w, r)
+		return
+	}
+	frame := client.Buffer.GetLatest()
+	if frame == nil {
+		http.NotFound(w, r)
+		return
+	}
+	w.Header().Set("Content-Type", "application/json")
+	json.NewEncoder(w).Encode(map[string]interface{}{
+		"clientId":  clientID,
+		"timestamp": frame.Timestamp,
+		"size":      frame.Size,
+		"stats":     map[string]interface{}{"frameCount": client.Buffer.frameCount, "fps": client.fps},
+	})
+}
+
 func main() {
 	port := ":8080"
 	server := NewStreamServer(BUFFER_SIZE)
@@ -370,6 +411,8 @@ func main() {
 	api := r.PathPrefix("/api").Subrouter()
 	api.HandleFunc("/clients", server.handleGetClients).Methods("GET")
 	api.HandleFunc("/clients/{id}/latest", server.handleGetLatestFrame).Methods("GET")
+	api.HandleFunc("/clients/{id}/latest.jpg", server.handleGetLatestFrameJPEG).Methods("GET")
+	api.HandleFunc("/clients/{id}/latest/meta", server.handleGetLatestFrameMeta).Methods("GET")
 
 	log.Printf("🚀 Server starting on port %s", port)
 	http.ListenAndServe(port, r)